@@ -3,4 +3,4 @@
 @REM pip3 install pyyaml pytz tzlocal requests
 
 SET PYTHONPATH=%cd%\..\pykintone
-py.exe -3 src\main.py
+py.exe -3 src\main.py %*
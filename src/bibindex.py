@@ -0,0 +1,272 @@
+import csv
+import heapq
+import json
+import mmap
+import os
+import shutil
+import struct
+import tempfile
+from typing import Iterable, Iterator, List, Tuple
+
+import oroshi
+
+
+# File layout:
+#   header:  magic, number of entries
+#   entries: (ISBN-13, offset of the data) sorted by ISBN-13
+#   data:    (title length, category length, title, category) in UTF-8
+# Lookups binary-search the memory-mapped entries, so opening an index costs
+# nothing and only the pages touched by a lookup are read.
+MAGIC = b'HONBIB01'
+HEADER = struct.Struct('<8sQ')
+ENTRY = struct.Struct('<13s3xQ')
+DATA_HEADER = struct.Struct('<HH')
+MAX_FIELD_BYTES = 0xffff
+# (ISBN-13, offset of the data) in the sorted runs written while building.
+# Big-endian so that packed pairs sort as bytes in the same order as numbers.
+RUN_ENTRY = struct.Struct('>13sQ')
+RUN_SIZE = 100000
+CHUNK_SIZE = 1 << 16
+BOM = '\ufeff'
+
+
+def isbn10_to_isbn13(isbn10: str) -> str:
+    body = '978' + isbn10[:9]
+    total = sum(int(c) * (1 if i % 2 == 0 else 3) for i, c in enumerate(body))
+    return body + str((10 - total % 10) % 10)
+
+
+def normalize_isbn(isbn: str) -> str:
+    isbn = isbn.replace('-', '').strip()
+    if len(isbn) == 10 and isbn[:9].isdigit():
+        return isbn10_to_isbn13(isbn)
+    if len(isbn) == 13 and isbn.isdigit():
+        return isbn
+    return None
+
+
+def _encode(s: str) -> bytes:
+    b = (s or '').encode('utf-8')
+    if len(b) <= MAX_FIELD_BYTES:
+        return b
+    return b[:MAX_FIELD_BYTES].decode('utf-8', 'ignore').encode('utf-8')
+
+
+def build_index(entries: Iterable[Tuple[str, str, str]], path: str, *,
+                run_size: int = RUN_SIZE) -> int:
+    # entries are (isbn, title, category). The first entry of an ISBN wins.
+    #
+    # A dump may have millions of entries, so they are never held in memory
+    # together. The data of each entry is appended to a temporary file as it
+    # is read, and the (ISBN-13, data offset) pairs are sorted on disk: runs
+    # of run_size pairs are sorted and written out, then merged.
+    if run_size <= 0:
+        raise ValueError('run_size must be positive', run_size)
+    with tempfile.TemporaryDirectory(
+            dir=os.path.dirname(os.path.abspath(path))) as tmp_dir:
+        data_path = os.path.join(tmp_dir, 'data')
+        run_paths = []
+        with open(data_path, 'wb') as data:
+            run = []
+            offset = 0
+            for isbn, title, category in entries:
+                isbn13 = normalize_isbn(isbn or '')
+                if not isbn13:
+                    continue
+                run.append(RUN_ENTRY.pack(isbn13.encode('ascii'), offset))
+                title, category = _encode(title), _encode(category)
+                data.write(DATA_HEADER.pack(len(title), len(category)))
+                data.write(title)
+                data.write(category)
+                offset += DATA_HEADER.size + len(title) + len(category)
+                if len(run) == run_size:
+                    run_paths.append(_write_run(run, tmp_dir, len(run_paths)))
+                    run = []
+            if run:
+                run_paths.append(_write_run(run, tmp_dir, len(run_paths)))
+
+        merged_path = os.path.join(tmp_dir, 'merged')
+        count = _merge_runs(run_paths, merged_path)
+
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(HEADER.pack(MAGIC, count))
+            data_start = HEADER.size + ENTRY.size * count
+            for isbn13, offset in _read_run(merged_path):
+                f.write(ENTRY.pack(isbn13, data_start + offset))
+            # The data of the entries which lost to an earlier one of the same
+            # ISBN is copied as well; no entry points to it.
+            with open(data_path, 'rb') as data:
+                shutil.copyfileobj(data, f)
+        os.replace(tmp_path, path)
+    return count
+
+
+def _write_run(run: List[bytes], tmp_dir: str, n: int) -> str:
+    # Packed RUN_ENTRY pairs sort as bytes by ISBN-13 first and then by
+    # offset, which is the order the entries were read in.
+    run.sort()
+    run_path = os.path.join(tmp_dir, 'run{}'.format(n))
+    with open(run_path, 'wb') as f:
+        f.writelines(run)
+    return run_path
+
+
+def _read_run(run_path: str) -> Iterator[Tuple[bytes, int]]:
+    with open(run_path, 'rb') as f:
+        for b in iter(lambda: f.read(RUN_ENTRY.size), b''):
+            yield RUN_ENTRY.unpack(b)
+
+
+def _merge_runs(run_paths: List[str], merged_path: str) -> int:
+    # Writes the merged pairs, only the first one of each ISBN-13, and returns
+    # how many were written.
+    count = 0
+    last_isbn13 = None
+    with open(merged_path, 'wb') as f:
+        for isbn13, offset in heapq.merge(*map(_read_run, run_paths)):
+            if isbn13 != last_isbn13:
+                f.write(RUN_ENTRY.pack(isbn13, offset))
+                last_isbn13 = isbn13
+                count += 1
+    return count
+
+
+class BibIndex:
+    def __init__(self, path: str):
+        with open(path, 'rb') as f:
+            self._mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self._count = HEADER.unpack_from(self._mm, 0)
+        if magic != MAGIC:
+            self._mm.close()
+            raise ValueError('not a bibliographic index file', path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __len__(self) -> int:
+        return self._count
+
+    def close(self):
+        self._mm.close()
+
+    def _entry(self, i: int) -> Tuple[bytes, int]:
+        return ENTRY.unpack_from(self._mm, HEADER.size + ENTRY.size * i)
+
+    def get(self, isbn: str) -> oroshi.BookMetadata:
+        isbn13 = normalize_isbn(isbn)
+        if isbn13 is None:
+            return None
+        key = isbn13.encode('ascii')
+
+        lo, hi = 0, self._count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._entry(mid)[0] < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo == self._count:
+            return None
+        entry_isbn, offset = self._entry(lo)
+        if entry_isbn != key:
+            return None
+
+        title_len, category_len = DATA_HEADER.unpack_from(self._mm, offset)
+        start = offset + DATA_HEADER.size
+        title = self._mm[start:start + title_len].decode('utf-8')
+        start += title_len
+        category = self._mm[start:start + category_len].decode('utf-8')
+        return oroshi.BookMetadata(title or None, category or None)
+
+
+def read_tsv(file) -> Iterator[Tuple[str, str, str]]:
+    # Each line is "ISBN<TAB>title[<TAB>category]".
+    for row in csv.reader(file, delimiter='\t'):
+        if len(row) >= 2:
+            yield row[0], row[1], row[2] if len(row) >= 3 else ''
+
+
+def read_openbd(file, *, chunk_size: int = CHUNK_SIZE) \
+        -> Iterator[Tuple[str, str, str]]:
+    # Reads a JSON array of openBD records, or one record per line. openBD
+    # has no category which matches the type field of the app, so the
+    # category is left empty.
+    first = file.read(1)
+    while first.isspace() or first == BOM:
+        first = file.read(1)
+    file.seek(0)
+    if first == '[':
+        books = _iter_json_array(file, chunk_size)
+    else:
+        books = (json.loads(line.lstrip(BOM))
+                 for line in file if line.strip())
+
+    for book in books:
+        summary = (book or {}).get('summary') or {}
+        if summary.get('isbn'):
+            yield summary['isbn'], summary.get('title', ''), ''
+
+
+def _iter_json_array(file, chunk_size: int) -> Iterator:
+    # Yields the elements of a JSON array one by one, reading chunk_size
+    # characters at a time, so that a dump of the whole openBD is not loaded
+    # at once.
+    decoder = json.JSONDecoder()
+    buf = ''
+    pos = 0
+    eof = False
+
+    def fill():
+        nonlocal buf, pos, eof
+        more = file.read(chunk_size)
+        if not more:
+            eof = True
+        buf = buf[pos:] + more
+        pos = 0
+
+    def skip(chars):
+        # Skips whitespace and chars, and returns the next character, or ''
+        # at the end of the file.
+        nonlocal pos
+        while True:
+            while pos < len(buf) and (buf[pos].isspace() or buf[pos] in chars):
+                pos += 1
+            if pos < len(buf) or eof:
+                return buf[pos:pos + 1]
+            fill()
+
+    if skip(BOM) != '[':
+        raise ValueError('not a JSON array')
+    pos += 1
+    while True:
+        c = skip(',')
+        if c == ']':
+            return
+        if c == '':
+            raise ValueError('unterminated JSON array')
+        try:
+            element, end = decoder.raw_decode(buf, pos)
+        except json.JSONDecodeError:
+            if eof:
+                raise
+            fill()
+            continue
+        if end == len(buf) and not eof:
+            # A number may go on in the next chunk.
+            fill()
+            continue
+        yield element
+        pos = end
+
+
+def build_index_from_file(dump_path: str, index_path: str) -> int:
+    with open(dump_path, encoding='utf-8-sig') as f:
+        if dump_path.endswith(('.json', '.jsonl')):
+            entries = read_openbd(f)
+        else:
+            entries = read_tsv(f)
+        return build_index(entries, index_path)
@@ -0,0 +1,302 @@
+import collections
+import io
+import json
+import re
+import threading
+import time
+from typing import List
+
+
+# Exchange is one HTTP request to kintone and its response. elapsed is the
+# time in seconds the request took when it was recorded.
+Exchange = collections.namedtuple(
+    'Exchange',
+    ['method', 'url', 'headers', 'request', 'status', 'response', 'elapsed'])
+# wall_time is the total time spent in requests.
+Stats = collections.namedtuple(
+    'Stats', ['calls', 'bytes_sent', 'bytes_received', 'wall_time'])
+
+SECRET_HEADERS = (
+    'X-Cybozu-API-Token', 'X-Cybozu-Authorization', 'Authorization')
+REDACTED = 'REDACTED'
+
+
+def encode_request(params_or_data) -> str:
+    return json.dumps(params_or_data, ensure_ascii=False, sort_keys=True)
+
+
+def redact_headers(headers: dict) -> dict:
+    if not headers:
+        return {}
+    return {k: (REDACTED if k in SECRET_HEADERS else v)
+            for k, v in headers.items()}
+
+
+# Cassette also keeps what the operator typed during the session, so that a
+# replayed session makes the same decisions, and the kintone domain and app
+# ID, which are needed to rebuild the same request URLs.
+class Cassette:
+    def __init__(self, exchanges: List[Exchange] = None,
+                 input_lines: List[str] = None, app: dict = None):
+        self.exchanges = [] if exchanges is None else exchanges
+        self.input_lines = [] if input_lines is None else input_lines
+        self.app = {} if app is None else app
+
+    @classmethod
+    def load(cls, path: str):
+        with open(path, encoding='utf-8') as f:
+            body = json.load(f)
+        return cls([Exchange(**e) for e in body['exchanges']],
+                   body['input_lines'], body['app'])
+
+    def save(self, path: str):
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump({'app': self.app,
+                       'exchanges': [e._asdict() for e in self.exchanges],
+                       'input_lines': self.input_lines},
+                      f, ensure_ascii=False, indent=1)
+
+    def stats(self) -> Stats:
+        return Stats(
+            calls=len(self.exchanges),
+            bytes_sent=sum(len(e.request.encode()) for e in self.exchanges),
+            bytes_received=sum(len(e.response.encode())
+                               for e in self.exchanges),
+            wall_time=sum(e.elapsed for e in self.exchanges))
+
+
+# FakeResponse has the part of requests.Response which pykintone uses.
+class FakeResponse:
+    def __init__(self, status: int, text: str):
+        self.status_code = status
+        self.text = text
+        self.content = text.encode()
+
+    @property
+    def ok(self) -> bool:
+        return self.status_code < 400
+
+    def json(self):
+        return json.loads(self.text)
+
+
+class _StatsCounter:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._stats = Stats(0, 0, 0, 0.0)
+
+    def add(self, request: str, response: str, elapsed: float):
+        with self._lock:
+            s = self._stats
+            self._stats = Stats(
+                s.calls + 1, s.bytes_sent + len(request.encode()),
+                s.bytes_received + len(response.encode()),
+                s.wall_time + elapsed)
+
+    def stats(self) -> Stats:
+        return self._stats
+
+
+# TeeInput passes lines through from file and keeps a copy of them.
+class TeeInput:
+    def __init__(self, file, lines: List[str]):
+        self._file = file
+        self._lines = lines
+
+    def readline(self) -> str:
+        line = self._file.readline()
+        if line:
+            self._lines.append(line)
+        return line
+
+    def __iter__(self):
+        return iter(self.readline, '')
+
+
+# Recorder wraps the _request method of a pykintone application and records
+# every exchange to the cassette. API tokens and passwords in the headers are
+# redacted before they are written to the cassette.
+class Recorder:
+    def __init__(self, cassette: Cassette):
+        self.cassette = cassette
+        self._lock = threading.Lock()
+        self._counter = _StatsCounter()
+
+    def install(self, kintone_app):
+        self.cassette.app = {'domain': kintone_app.account.domain,
+                              'app_id': kintone_app.app_id}
+        kintone_app._request = self.wrap(kintone_app._request)
+
+    def wrap(self, request):
+        def recording_request(method, url, params_or_data, headers=None,
+                              **kwargs):
+            start = time.perf_counter()
+            resp = request(method, url, params_or_data, headers=headers,
+                           **kwargs)
+            elapsed = time.perf_counter() - start
+
+            exchange = Exchange(
+                method=method.upper(), url=url,
+                headers=redact_headers(headers),
+                request=encode_request(params_or_data),
+                status=resp.status_code, response=resp.text, elapsed=elapsed)
+            with self._lock:
+                self.cassette.exchanges.append(exchange)
+            self._counter.add(exchange.request, exchange.response, elapsed)
+            return resp
+
+        return recording_request
+
+    def input(self, file) -> TeeInput:
+        return TeeInput(file, self.cassette.input_lines)
+
+    def stats(self) -> Stats:
+        return self._counter.stats()
+
+
+# request_shape is what is left of a request when the values, such as the
+# ISBNs in a query or the records of a batch update, are taken out. Requests
+# of the same shape are the same kind of request with other arguments.
+_QUERY_LITERAL = re.compile(r'"(?:[^"\\]|\\.)*"|\b\d+\b')
+_QUERY_LIST = re.compile(r'\?(?:\s*,\s*\?)+')
+
+
+def request_shape(params_or_data) -> str:
+    def shape(value, key=None):
+        if isinstance(value, dict):
+            return {k: shape(v, k) for k, v in value.items()}
+        if isinstance(value, list):
+            return [shape(value[0])] if value else []
+        if key == 'query' and isinstance(value, str):
+            return _QUERY_LIST.sub('?', _QUERY_LITERAL.sub('?', value))
+        return type(value).__name__
+
+    return encode_request(shape(params_or_data))
+
+
+# Player answers the requests from the cassette instead of kintone, so that
+# a change in how the requests are made can be measured against the
+# recording. A request is answered, in this order of preference, by
+#   - a recorded exchange with the same method, URL and body,
+#   - one with the same method, URL and request_shape ("changed"),
+#   - any other one for the same method and URL ("new"),
+# taking unused exchanges in the order they were recorded, so concurrent
+# requests may come in any order. When all of them are used, the last one
+# is answered again. A request to a URL which was never recorded gets a
+# kintone-like error response. differences() lists the requests which did
+# not match exactly and the exchanges which were never requested.
+#
+# Each answer takes the recorded time multiplied by time_scale; 0 replays as
+# fast as possible. stats() measures the time actually spent in requests,
+# divided by time_scale to be comparable with the recording.
+class Player:
+    NOT_RECORDED = 'CASSETTE_NOT_RECORDED'
+
+    def __init__(self, cassette: Cassette, *, time_scale: float = 1.0,
+                 sleep=time.sleep):
+        self.cassette = cassette
+        self._time_scale = time_scale
+        self._sleep = sleep
+        self._lock = threading.Lock()
+        self._counter = _StatsCounter()
+        self._recorded_time = 0.0
+        self._differences = []
+        # unused exchanges by (method, url) and by (method, url, shape)
+        self._unused = {}
+        self._unused_by_shape = {}
+        self._last = {}
+        for e in cassette.exchanges:
+            self._unused.setdefault((e.method, e.url), []).append(e)
+            shape = request_shape(json.loads(e.request))
+            self._unused_by_shape.setdefault(
+                (e.method, e.url, shape), []).append(e)
+
+    def install(self, kintone_app):
+        kintone_app._request = self.wrap(kintone_app._request)
+
+    def wrap(self, request):
+        def replaying_request(method, url, params_or_data, headers=None,
+                              **kwargs):
+            start = time.perf_counter()
+            body = encode_request(params_or_data)
+            exchange = self._match(method.upper(), url, params_or_data, body)
+            if exchange is None:
+                resp = FakeResponse(404, json.dumps({
+                    'code': self.NOT_RECORDED, 'id': '',
+                    'message': 'no recorded response for the URL'}))
+            else:
+                if self._time_scale > 0:
+                    self._sleep(exchange.elapsed * self._time_scale)
+                resp = FakeResponse(exchange.status, exchange.response)
+            self._counter.add(body, resp.text, time.perf_counter() - start)
+            return resp
+
+        return replaying_request
+
+    def _match(self, method: str, url: str, params_or_data, body: str) \
+            -> Exchange:
+        endpoint = (method, url)
+        shape = request_shape(params_or_data)
+        with self._lock:
+            same_shape = self._unused_by_shape.get(endpoint + (shape,), [])
+            exchange = next((e for e in same_shape if e.request == body), None)
+            if exchange is None and same_shape:
+                exchange = same_shape[0]
+                self._difference('changed', method, url, body)
+            if exchange is None and self._unused.get(endpoint):
+                exchange = self._unused[endpoint][0]
+                self._difference('new', method, url, body)
+            if exchange is None:
+                self._difference('new', method, url, body)
+                exchange = self._last.get(endpoint)
+                if exchange is None:
+                    return None
+            else:
+                self._use(exchange)
+            self._last[endpoint] = exchange
+            self._recorded_time += exchange.elapsed
+            return exchange
+
+    def _use(self, exchange: Exchange):
+        self._unused[(exchange.method, exchange.url)].remove(exchange)
+        shape = request_shape(json.loads(exchange.request))
+        self._unused_by_shape[(exchange.method, exchange.url, shape)].remove(
+            exchange)
+
+    def _difference(self, kind: str, method: str, url: str, body: str):
+        self._differences.append('{}: {} {} {}'.format(kind, method, url, body))
+
+    def differences(self) -> List[str]:
+        with self._lock:
+            not_sent = ['not sent: {} {} {}'.format(e.method, e.url, e.request)
+                        for exchanges in self._unused.values()
+                        for e in exchanges]
+            return self._differences + not_sent
+
+    def input(self, file=None) -> io.StringIO:
+        # The recorded input is used instead of file.
+        return io.StringIO(''.join(self.cassette.input_lines))
+
+    def num_unused(self) -> int:
+        return sum(len(q) for q in self._unused.values())
+
+    def stats(self) -> Stats:
+        stats = self._counter.stats()
+        if self._time_scale > 0:
+            return stats._replace(wall_time=stats.wall_time / self._time_scale)
+        # Without waiting, only the recorded time of the answers is known.
+        return stats._replace(wall_time=self._recorded_time)
+
+
+def compare_stats(stats: Stats, baseline: Stats, *,
+                  tolerance: float = 0.1) -> List[str]:
+    # Returns a message for each figure which is worse than the baseline by
+    # more than tolerance (a ratio).
+    regressions = []
+    for field in Stats._fields:
+        value = getattr(stats, field)
+        base = getattr(baseline, field)
+        if value > base * (1 + tolerance):
+            regressions.append('{}: {} (baseline {})'.format(
+                field, value, base))
+    return regressions
@@ -0,0 +1,127 @@
+import oroshi
+
+
+ISBN1 = '9784789849944'
+ISBN2 = '9784839919849'
+ISBN3 = '4810180778'
+# No fake record has ISBN4.
+ISBN4 = '9784873117386'
+
+IN_SHELF = oroshi.RecordStatus.IN_SHELF
+BORROWED = oroshi.RecordStatus.BORROWED
+LOST = oroshi.RecordStatus.LOST
+
+FAKE_RECORD1  = oroshi.BookRecord(1,  IN_SHELF, 'book1', '', ISBN1, 'o', True,  'UI')
+FAKE_RECORD2  = oroshi.BookRecord(2,  IN_SHELF, 'book1', '', ISBN1, 'o', False, 'UI')
+FAKE_RECORD3  = oroshi.BookRecord(3,  IN_SHELF, 'book1', '', ISBN1, 'x', True,  'UI')
+FAKE_RECORD4  = oroshi.BookRecord(4,  IN_SHELF, 'book1', '', ISBN1, 'x', False, 'UI')
+FAKE_RECORD11 = oroshi.BookRecord(11, BORROWED, 'book1', '', ISBN1, 'o', True,  'UI')
+FAKE_RECORD12 = oroshi.BookRecord(12, BORROWED, 'book1', '', ISBN1, 'o', False, 'UI')
+FAKE_RECORD13 = oroshi.BookRecord(13, BORROWED, 'book1', '', ISBN1, 'x', True,  'UI')
+FAKE_RECORD14 = oroshi.BookRecord(14, BORROWED, 'book1', '', ISBN1, 'x', False, 'UI')
+FAKE_RECORD21 = oroshi.BookRecord(21, LOST,     'book1', '', ISBN1, 'o', True,  'UI')
+FAKE_RECORD22 = oroshi.BookRecord(22, LOST,     'book1', '', ISBN1, 'o', False, 'UI')
+FAKE_RECORD23 = oroshi.BookRecord(23, LOST,     'book1', '', ISBN1, 'x', True,  'UI')
+FAKE_RECORD24 = oroshi.BookRecord(24, LOST,     'book1', '', ISBN1, 'x', False, 'UI')
+FAKE_RECORD30 = oroshi.BookRecord(30, IN_SHELF, 'book2', '', ISBN2, 'o', False, 'UI')
+FAKE_RECORD31 = oroshi.BookRecord(31, IN_SHELF, 'book3', ISBN3, '', 'o', False, 'UI')
+
+# The records as kintone returns them, with revisions.
+KINTONE_RECORDS = [
+    FAKE_RECORD2._replace(revision=5),
+    FAKE_RECORD22._replace(revision=7),
+    FAKE_RECORD30._replace(revision=1),
+]
+
+
+def make_record(record_id: int, inventoried: bool) -> oroshi.BookRecord:
+    # A record of a book of its own, for tests which need many records.
+    return oroshi.BookRecord(
+        record_id, IN_SHELF, 'book{}'.format(record_id), '',
+        '978{:010}'.format(record_id), 'o', inventoried, 'UI', 1)
+
+
+# FakeBookstore, like kintone, bumps the revision on every change and rejects
+# writes with an old revision. Records without a revision keep having none.
+# It remembers which ISBNs were looked up and counts the other requests.
+class FakeBookstore(oroshi.Bookstore):
+    def __init__(self, records):
+        self._records = {r.record_id: r for r in records}
+        self.added = []
+        self.lookups = []
+        self.num_requests = 0
+
+    def find_records_by_isbns(self, isbns):
+        isbns = list(isbns)
+        self.lookups.append(isbns)
+        return [r for r in sorted(self._records.values())
+                if r.isbn10 in isbns or r.isbn13 in isbns]
+
+    def find_records_by_isbn(self, isbn: str):
+        return self.find_records_by_isbns([isbn])
+
+    def get_record(self, record_id: int):
+        return self._records.get(record_id)
+
+    def find_inventoried_records(self, after_id: int = 0):
+        for record_id in sorted(self._records):
+            record = self._records[record_id]
+            if record_id > after_id and record.inventoried:
+                yield record
+
+    @staticmethod
+    def _next_revision(record):
+        return None if record.revision is None else record.revision + 1
+
+    def edit(self, record_id: int, **kwargs):
+        r = self._records[record_id]
+        self._records[record_id] = r._replace(
+            revision=self._next_revision(r), **kwargs)
+
+    def _check(self, records):
+        self.num_requests += 1
+        for r in records:
+            current = self._records.get(r.record_id)
+            if current is None:
+                raise RuntimeError(
+                    'not found any records with ID', r.record_id)
+            if r.revision is not None and r.revision != current.revision:
+                raise oroshi.RevisionConflict('revision mismatch', r.record_id)
+
+    def add_records(self, records):
+        self.num_requests += 1
+        for r in records:
+            record_id = max(self._records, default=0) + 1
+            self._records[record_id] = r._replace(
+                record_id=record_id, revision=1)
+            self.added.append(r)
+
+    def add_record(self, record):
+        self.add_records([record])
+
+    def update_records(self, records):
+        records = list(records)
+        self._check(records)
+        for r in records:
+            current = self._records[r.record_id]
+            self._records[r.record_id] = r._replace(
+                status=current.status, revision=self._next_revision(current))
+
+    def update_record(self, record):
+        self.update_records([record])
+
+    def found_records(self, records):
+        records = list(records)
+        self._check(records)
+        for r in records:
+            self.edit(r.record_id, status=IN_SHELF)
+        return {r.record_id: self._records[r.record_id].revision
+                for r in records}
+
+    def found(self, record_id: int):
+        self.found_records([self._records[record_id]])
+
+    def get_revisions(self, record_ids):
+        self.num_requests += 1
+        return {i: self._records[i].revision
+                for i in record_ids if i in self._records}
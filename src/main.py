@@ -1,11 +1,22 @@
 #!/usr/bin/python3
 
+import argparse
+import collections
+import sys
+
 import pykintone
 import pykintone.model
 import pykintone.structure
 from typing import Iterable
 
+import bibindex
+import cassette
+import metrics
+import offline
 import oroshi
+import plancache
+import reset
+import writebehind
 
 
 class RawBookRecord(pykintone.model.kintoneModel):
@@ -24,11 +35,13 @@ class RawBookRecord(pykintone.model.kintoneModel):
             self.inventoried, self.type)
 
     @staticmethod
-    def from_book_record(record: oroshi.BookRecord):
+    def from_book_record(record: oroshi.BookRecord, with_revision=False):
         raw_inventoried = ['済み'] if record.inventoried else []
 
         raw_record = RawBookRecord()
         raw_record.record_id = record.record_id
+        if with_revision and record.revision is not None:
+            raw_record.revision = record.revision
         raw_record.title = record.title
         raw_record.isbn10 = record.isbn10
         raw_record.isbn13 = record.isbn13
@@ -39,14 +52,6 @@ class RawBookRecord(pykintone.model.kintoneModel):
         return raw_record
 
 
-STATUS_MAP = {
-    '本棚にあります': oroshi.RecordStatus.IN_SHELF,
-    'レンタル中': oroshi.RecordStatus.BORROWED,
-    'レンタル中(まであと一歩)': oroshi.RecordStatus.BORROWED,
-    '紛失中': oroshi.RecordStatus.LOST,
-}
-
-
 class RawBookRecordWithStatus(RawBookRecord):
     def __init__(self):
         super().__init__()
@@ -62,7 +67,7 @@ class RawBookRecordWithStatus(RawBookRecord):
             self.inventoried, self.status)
 
     def to_book_record(self) -> oroshi.BookRecord:
-        status = STATUS_MAP[self.status]
+        status = oroshi.STATUS_MAP[self.status]
         inventoried = len(self.inventoried) > 0
         return oroshi.BookRecord(
             record_id=self.record_id,
@@ -72,13 +77,64 @@ class RawBookRecordWithStatus(RawBookRecord):
             isbn13=self.isbn13,
             exists=self.exists,
             inventoried=inventoried,
-            type=self.type)
+            type=self.type,
+            revision=self.revision)
+
+
+UPDATE_LIMIT = pykintone.kintoneService.UPDATE_LIMIT
+REVISION_CONFLICT = 'GAIA_CO02'
+# kintone error codes of requests which fail because of the records sent:
+# invalid field values and records which do not exist.
+RECORDS_REJECTED = ('CB_VA01', 'GAIA_RE01')
+
+
+def check_result(result, msg: str):
+    if result.ok:
+        return
+    if result.error.code == REVISION_CONFLICT:
+        raise oroshi.RevisionConflict(msg, result.error)
+    if result.error.code in RECORDS_REJECTED:
+        raise oroshi.RecordsRejected(msg, result.error)
+    raise RuntimeError(msg, result.error)
 
 
 class KintoneBookstore(oroshi.Bookstore):
+    CURSOR_SIZE = 500
+    SELECT_LIMIT = pykintone.kintoneService.SELECT_LIMIT
+
     def __init__(self, kintone_app):
         self._kintone_app = kintone_app
 
+    def _url(self, api: str) -> str:
+        app = self._kintone_app
+        return app.API_ROOT.format(app.account.domain, api)
+
+    def _iter_records_with_cursor(self, query: str) \
+            -> Iterable[oroshi.BookRecord]:
+        # pykintone has no cursor API, so talk to the REST API directly.
+        app = self._kintone_app
+        url = self._url('records/cursor.json')
+        resp = app._request('POST', url, {
+            'app': app.app_id, 'query': query, 'size': self.CURSOR_SIZE})
+        if not resp.ok:
+            raise RuntimeError('failed to create a cursor', resp.text)
+        cursor_id = resp.json()['id']
+
+        finished = False
+        try:
+            while not finished:
+                resp = app._request('GET', url, {'id': cursor_id})
+                if not resp.ok:
+                    raise RuntimeError('failed to read the cursor', resp.text)
+                body = resp.json()
+                finished = not body['next']
+                for r in body['records']:
+                    raw_record = RawBookRecordWithStatus.record_to_model(r)
+                    yield raw_record.to_book_record()
+        finally:
+            if not finished:
+                app._request('DELETE', url, {'id': cursor_id})
+
     def find_records_by_isbn(self, isbn: str) -> Iterable[oroshi.BookRecord]:
         if len(isbn) == 10:
             query = 'isbn10 = "{}"'.format(isbn)
@@ -90,6 +146,40 @@ class KintoneBookstore(oroshi.Bookstore):
         records = self._kintone_app.select(query).models(RawBookRecordWithStatus)
         return (r.to_book_record() for r in records)
 
+    def find_records_by_isbns(self, isbns: Iterable[str]) \
+            -> Iterable[oroshi.BookRecord]:
+        isbns_by_field = {'isbn10': [], 'isbn13': []}
+        for isbn in isbns:
+            if len(isbn) == 10:
+                isbns_by_field['isbn10'].append(isbn)
+            elif len(isbn) == 13:
+                isbns_by_field['isbn13'].append(isbn)
+            else:
+                raise ValueError('ISBN length must be 10 or 13', isbn)
+
+        conditions = []
+        for field, field_isbns in isbns_by_field.items():
+            if field_isbns:
+                conditions.append('{} in ({})'.format(
+                    field, ', '.join('"{}"'.format(i) for i in field_isbns)))
+        if not conditions:
+            return iter(())
+        return self._select_all(' or '.join(conditions))
+
+    def _select_all(self, query: str) -> Iterable[oroshi.BookRecord]:
+        offset = 0
+        while True:
+            paged_query = '{} order by $id asc limit {} offset {}'.format(
+                query, self.SELECT_LIMIT, offset)
+            result = self._kintone_app.select(paged_query)
+            check_result(result, 'failed to select records')
+            records = result.models(RawBookRecordWithStatus)
+            for r in records:
+                yield r.to_book_record()
+            if len(result.records) < self.SELECT_LIMIT:
+                return
+            offset += self.SELECT_LIMIT
+
     def get_record(self, record_id: int) -> oroshi.BookRecord:
         record = self._kintone_app.get(record_id)
         return record.model(RawBookRecordWithStatus).to_book_record()
@@ -103,12 +193,360 @@ class KintoneBookstore(oroshi.Bookstore):
     def found(self, record_id: int):
         return self._kintone_app.proceed_by_id(record_id, '発見')
 
+    def find_all_records(self) -> Iterable[oroshi.BookRecord]:
+        return self._iter_records_with_cursor('order by $id asc')
+
+    def find_inventoried_records(self, after_id: int = 0) \
+            -> Iterable[oroshi.BookRecord]:
+        query = 'inventoried in ("済み") and $id > {} order by $id asc'.format(
+            after_id)
+        return self._iter_records_with_cursor(query)
+
+    def add_records(self, records: Iterable[oroshi.BookRecord]):
+        raw_records = [RawBookRecord.from_book_record(r) for r in records]
+        for i in range(0, len(raw_records), UPDATE_LIMIT):
+            result = self._kintone_app.batch_create(
+                raw_records[i:i + UPDATE_LIMIT])
+            check_result(result, 'failed to add records')
+
+    def update_records(self, records: Iterable[oroshi.BookRecord]):
+        # Unlike update_record, records are checked against their revisions.
+        raw_records = [RawBookRecord.from_book_record(r, with_revision=True)
+                       for r in records]
+        for i in range(0, len(raw_records), UPDATE_LIMIT):
+            result = self._kintone_app.batch_update(
+                raw_records[i:i + UPDATE_LIMIT])
+            check_result(result, 'failed to update records')
+
+    def clear_inventoried(self, record_ids: Iterable[int]):
+        # pykintone sends every field of a model, so talk to the REST API
+        # directly to send the inventoried field only.
+        app = self._kintone_app
+        url = self._url('records.json')
+        record_ids = list(record_ids)
+        for i in range(0, len(record_ids), UPDATE_LIMIT):
+            resp = app._request('PUT', url, {
+                'app': app.app_id,
+                'records': [{'id': r, 'record': {'inventoried': {'value': []}}}
+                            for r in record_ids[i:i + UPDATE_LIMIT]]})
+            if not resp.ok:
+                raise RuntimeError(
+                    'failed to clear the inventoried flags', resp.text)
+
+    def found_records(self, records: Iterable[oroshi.BookRecord]) -> dict:
+        raw_records = [RawBookRecord.from_book_record(r, with_revision=True)
+                       for r in records]
+        revisions = {}
+        for i in range(0, len(raw_records), UPDATE_LIMIT):
+            result = self._kintone_app.batch_proceed(
+                raw_records[i:i + UPDATE_LIMIT], '発見')
+            check_result(result, 'failed to proceed records')
+            revisions.update(result.keys)
+        return revisions
+
+    def get_revisions(self, record_ids: Iterable[int]) -> dict:
+        revisions = {}
+        record_ids = list(record_ids)
+        for i in range(0, len(record_ids), self.SELECT_LIMIT):
+            query = '$id in ({}) limit {}'.format(
+                ', '.join(str(r) for r in record_ids[i:i + self.SELECT_LIMIT]),
+                self.SELECT_LIMIT)
+            result = self._kintone_app.select(
+                query, fields=['$id', '$revision'])
+            check_result(result, 'failed to select revisions')
+            for r in result.records:
+                revisions[int(r['$id']['value'])] = int(
+                    r['$revision']['value'])
+        return revisions
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='kintone 図書管理システムの棚卸用ツール')
+    parser.add_argument(
+        'command', nargs='?', default='oroshi',
+        choices=['oroshi', 'reset', 'export', 'flush', 'conflicts',
+                 'bibindex'],
+        help=('oroshi: 棚卸をする, reset: 全レコードの棚卸フラグを外す, '
+              'export: kintone の全レコードを --sqlite のファイルに書き出す, '
+              'flush: --queue のファイルに溜めた更新を kintone に送る, '
+              'conflicts: --queue のファイルで確認待ちの更新を表示する, '
+              'bibindex: --bibdump から --bibindex の書誌索引を作る'))
+    backend = parser.add_mutually_exclusive_group()
+    backend.add_argument(
+        '--sqlite', metavar='PATH',
+        help='kintone の代わりに SQLite ファイルを使う')
+    backend.add_argument(
+        '--csv', metavar='PATH',
+        help='kintone の代わりに kintone から書き出した CSV ファイルを使う')
+    parser.add_argument(
+        '--csv-encoding', default='utf-8-sig',
+        help='CSV ファイルの文字コード')
+    parser.add_argument(
+        '--checkpoint', default='reset.checkpoint',
+        help='reset の進捗を保存するファイル')
+    parser.add_argument(
+        '--resume', action='store_true',
+        help='中断した reset を --checkpoint のファイルの続きから再開する')
+    parser.add_argument(
+        '--workers', type=int, default=4,
+        help='reset で同時に送る一括更新リクエストの数')
+    parser.add_argument(
+        '--queue', metavar='PATH',
+        help='更新をすぐに送らず、このファイルに溜める')
+    parser.add_argument(
+        '--flush-interval', type=float, metavar='SECONDS',
+        help='溜めた更新を kintone に送る間隔')
+    parser.add_argument(
+        '--clear', action='store_true',
+        help='conflicts で、表示した更新を確認済みにして次からは表示しない')
+    traffic = parser.add_mutually_exclusive_group()
+    traffic.add_argument(
+        '--record', metavar='PATH',
+        help='kintone との通信と入力をこのファイルに記録する（API トークンは伏せる）')
+    traffic.add_argument(
+        '--replay', metavar='PATH',
+        help='kintone に接続せず、--record で記録した通信と入力を再生する')
+    parser.add_argument(
+        '--time-scale', type=float, default=1.0,
+        help='再生時に記録された応答時間に掛ける倍率（0 なら待たない）')
+    parser.add_argument(
+        '--tolerance', type=float, default=0.1,
+        help='再生時、記録より呼び出し回数・転送量・時間がこの割合を超えて増えたら失敗にする')
+    parser.add_argument(
+        '--bibindex', metavar='PATH',
+        help='新規登録する本のタイトルをこの書誌索引から引く')
+    parser.add_argument(
+        '--bibdump', metavar='PATH',
+        help='書誌索引の元データ（openBD の JSON、または ISBN・タイトル・種類の TSV）')
+    parser.add_argument(
+        '--plan-cache', metavar='PATH',
+        help='検索結果とアクション一覧をこのファイルに残し、次の棚卸では変わった本だけを検索して差分を表示する')
+    parser.add_argument(
+        '--metrics-port', type=int, metavar='PORT',
+        help='このポートの http://127.0.0.1:PORT/metrics で進捗の指標を公開する')
+    args = parser.parse_args()
+    if args.command == 'bibindex' and not (args.bibdump and args.bibindex):
+        parser.error('bibindex requires --bibdump and --bibindex')
+    if args.command == 'export' and not args.sqlite:
+        parser.error('export requires --sqlite')
+    if args.command in ('flush', 'conflicts') and not args.queue:
+        parser.error('{} requires --queue'.format(args.command))
+    return args
+
+
+# Runtime holds the optional hooks which are installed on kintone apps and
+# given to Oroshi: a cassette.Recorder or cassette.Player, and
+# metrics.OroshiMetrics.
+Runtime = collections.namedtuple('Runtime', ['traffic', 'metrics'])
+NO_RUNTIME = Runtime(None, None)
+
+
+def open_kintone_bookstore(rt: Runtime = NO_RUNTIME) -> KintoneBookstore:
+    if isinstance(rt.traffic, cassette.Player):
+        # Nothing is sent to kintone, so kintone.yml is not needed.
+        app = rt.traffic.cassette.app
+        kinapp = pykintone.app(app['domain'], app['app_id'], '')
+    else:
+        kinapp = pykintone.load('kintone.yml').app(app_name='hondana')
+    if rt.traffic:
+        rt.traffic.install(kinapp)
+    if rt.metrics:
+        rt.metrics.install(kinapp)
+    return KintoneBookstore(kinapp)
+
+
+def open_bookstore(args, rt: Runtime = NO_RUNTIME) -> oroshi.Bookstore:
+    if args.sqlite:
+        return offline.SqliteBookstore(args.sqlite)
+    if args.csv:
+        return offline.CsvBookstore(args.csv, encoding=args.csv_encoding)
+    return open_kintone_bookstore(rt)
+
+
+def open_traffic(args):
+    if args.record:
+        return cassette.Recorder(cassette.Cassette())
+    if args.replay:
+        return cassette.Player(
+            cassette.Cassette.load(args.replay), time_scale=args.time_scale)
+    return None
+
+
+def report_traffic(args, traffic) -> bool:
+    # returns False if the replayed session was slower than the recording
+    stats = traffic.stats()
+    oroshi.log('kintone traffic: {} calls, {} bytes sent, {} bytes received, '
+               '{:.3f} s'.format(*stats))
+    if isinstance(traffic, cassette.Recorder):
+        traffic.cassette.save(args.record)
+        return True
+
+    for difference in traffic.differences():
+        oroshi.log(difference)
+    regressions = cassette.compare_stats(
+        stats, traffic.cassette.stats(), tolerance=args.tolerance)
+    for regression in regressions:
+        oroshi.log('regression:', regression)
+    return not regressions
+
+
+def show_conflicts(args, queue: writebehind.WriteQueue):
+    conflicts = queue.conflicts()
+    for write, message in conflicts:
+        r = write.record
+        oroshi.log('conflict: {} record {} "{}" (ISBN={}): {}'.format(
+            write.kind, r.record_id, r.title, oroshi.get_isbn(r), message))
+    if not conflicts:
+        return
+    if args.command == 'conflicts' and args.clear:
+        n = queue.mark_reviewed(w for w, _ in conflicts)
+        oroshi.log('marked {} conflicts as reviewed'.format(n))
+    else:
+        oroshi.log('after reviewing them in kintone, run: '
+                   'conflicts --queue {} --clear'.format(args.queue))
+
+
+def flush(args, rt: Runtime = NO_RUNTIME):
+    with writebehind.WriteQueue(args.queue) as queue:
+        # The offline bookstore, if any, gets the flushed books back.
+        local = open_bookstore(args) if args.sqlite or args.csv else None
+        try:
+            flusher = writebehind.Flusher(
+                queue, open_kintone_bookstore(rt), local=local)
+            interval = args.flush_interval or 60
+            flushed = writebehind.flush_until_empty(flusher, queue, interval)
+        finally:
+            if local:
+                local.close()
+        show_conflicts(args, queue)
+        if not flushed:
+            oroshi.log('gave up flushing; {} writes are waiting in {}'.format(
+                queue.num_pending(), args.queue))
+            sys.exit(1)
+
+
+def run_oroshi(args, bookstore: oroshi.Bookstore, rt: Runtime = NO_RUNTIME):
+    if args.bibindex:
+        with bibindex.BibIndex(args.bibindex) as index:
+            run_oroshi_with_index(args, bookstore, rt, index)
+    else:
+        run_oroshi_with_index(args, bookstore, rt, None)
+
+
+def run_oroshi_with_index(args, bookstore: oroshi.Bookstore, rt: Runtime,
+                          index):
+    stdin = rt.traffic.input(sys.stdin) if rt.traffic else sys.stdin
+
+    plan_cache = None
+    if args.plan_cache:
+        plan_cache = plancache.PlanCache(args.plan_cache)
+
+    def new_oroshi(bookstore):
+        return oroshi.Oroshi(
+            bookstore, stdin=stdin, bibindex=index, metrics=rt.metrics,
+            plan_cache=plan_cache)
+
+    if not args.queue:
+        new_oroshi(bookstore).run_once()
+        return
+    if (isinstance(bookstore, offline.CsvBookstore)
+            and not bookstore.has_revisions):
+        # The queued writes could not be checked against edits in kintone.
+        raise ValueError(
+            'CSV file must have the column $revision to be used with --queue',
+            args.csv)
+
+    with writebehind.WriteQueue(args.queue) as queue:
+        background_flusher = None
+        if args.flush_interval:
+            if isinstance(bookstore, KintoneBookstore):
+                target, local = bookstore, None
+            else:
+                target, local = open_kintone_bookstore(rt), bookstore
+            background_flusher = writebehind.BackgroundFlusher(
+                writebehind.Flusher(queue, target, local=local),
+                args.flush_interval)
+            background_flusher.start()
+        try:
+            bookstore = writebehind.WriteBehindBookstore(bookstore, queue)
+            new_oroshi(bookstore).run_once()
+        finally:
+            if background_flusher:
+                background_flusher.stop()
+                if background_flusher.num_errors:
+                    oroshi.log('flushing failed {} times'.format(
+                        background_flusher.num_errors))
+            oroshi.log('{} writes are waiting in {}'.format(
+                queue.num_pending(), args.queue))
+            show_conflicts(args, queue)
+
+
+def run_command(args, rt: Runtime = NO_RUNTIME):
+    if args.command == 'bibindex':
+        n = bibindex.build_index_from_file(args.bibdump, args.bibindex)
+        oroshi.log('indexed {} books into {}'.format(n, args.bibindex))
+        return
+    if args.command == 'export':
+        with offline.SqliteBookstore(args.sqlite) as sqlite_bookstore:
+            sqlite_bookstore.import_records(
+                open_kintone_bookstore(rt).find_all_records())
+        return
+    if args.command == 'flush':
+        flush(args, rt)
+        return
+    if args.command == 'conflicts':
+        with writebehind.WriteQueue(args.queue) as queue:
+            show_conflicts(args, queue)
+        return
+
+    bookstore = open_bookstore(args, rt)
+    try:
+        if args.command == 'reset':
+            resetter = reset.InventoryResetter(
+                bookstore, batch_size=UPDATE_LIMIT, workers=args.workers,
+                checkpoint=reset.Checkpoint(args.checkpoint),
+                resume=args.resume)
+            try:
+                resetter.run()
+            except reset.InterruptedReset as e:
+                oroshi.log('{}: run with --resume to continue it, or remove {} '
+                           'to start over'.format(e, args.checkpoint))
+                sys.exit(1)
+            return
+
+        run_oroshi(args, bookstore, rt)
+    finally:
+        bookstore.close()
+
+
+def open_metrics(args):
+    if args.metrics_port is None:
+        return None, None
+    oroshi_metrics = metrics.OroshiMetrics()
+    server = metrics.MetricsServer(oroshi_metrics.registry, args.metrics_port)
+    server.start()
+    oroshi.log('metrics: http://127.0.0.1:{}/metrics'.format(server.port))
+    return oroshi_metrics, server
+
 
 def main():
-    kinapp = pykintone.load('kintone.yml').app(app_name='hondana')
-    bookstore = KintoneBookstore(kinapp)
-    o = oroshi.Oroshi(bookstore)
-    o.run_once()
+    args = parse_args()
+    traffic = open_traffic(args)
+    oroshi_metrics, metrics_server = open_metrics(args)
+    rt = Runtime(traffic, oroshi_metrics)
+
+    ok = True
+    try:
+        run_command(args, rt)
+    finally:
+        if metrics_server:
+            metrics_server.stop()
+        if traffic:
+            # "quit" at the prompt exits via SystemExit; keep the session
+            # anyway.
+            ok = report_traffic(args, traffic)
+    if not ok:
+        sys.exit(1)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,294 @@
+import bisect
+import collections
+import contextlib
+import http.server
+import json
+import threading
+import time
+from typing import Iterable
+
+
+def _format_labels(names, values) -> str:
+    if not names:
+        return ''
+    return '{' + ','.join(
+        '{}={}'.format(n, json.dumps(str(v), ensure_ascii=False))
+        for n, v in zip(names, values)) + '}'
+
+
+def _format_value(value) -> str:
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _Metric:
+    TYPE = None
+
+    def __init__(self, name: str, help: str, labels: Iterable[str] = ()):
+        self.name = name
+        self.help = help
+        self.label_names = tuple(labels)
+        self._lock = threading.Lock()
+        self._values = {}
+
+    def render(self) -> Iterable[str]:
+        yield '# HELP {} {}'.format(self.name, self.help)
+        yield '# TYPE {} {}'.format(self.name, self.TYPE)
+        with self._lock:
+            values = sorted(self._values.items())
+        for label_values, value in values:
+            yield from self._render_value(label_values, value)
+
+    def _render_value(self, label_values, value) -> Iterable[str]:
+        yield '{}{} {}'.format(
+            self.name, _format_labels(self.label_names, label_values),
+            _format_value(value))
+
+
+class Counter(_Metric):
+    TYPE = 'counter'
+
+    def inc(self, *label_values, amount=1):
+        with self._lock:
+            self._values[label_values] = (
+                self._values.get(label_values, 0) + amount)
+
+
+class Gauge(_Metric):
+    TYPE = 'gauge'
+
+    def set(self, value, *label_values):
+        with self._lock:
+            self._values[label_values] = value
+
+    def inc(self, *label_values, amount=1):
+        with self._lock:
+            self._values[label_values] = (
+                self._values.get(label_values, 0) + amount)
+
+    def dec(self, *label_values, amount=1):
+        self.inc(*label_values, amount=-amount)
+
+
+# FunctionGauge computes its value when it is rendered.
+class FunctionGauge(_Metric):
+    TYPE = 'gauge'
+
+    def __init__(self, name: str, help: str, function):
+        super().__init__(name, help)
+        self._function = function
+
+    def render(self) -> Iterable[str]:
+        self._values = {(): self._function()}
+        return super().render()
+
+
+class Histogram(_Metric):
+    TYPE = 'histogram'
+    DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                       1, 2.5, 5, 10)
+
+    def __init__(self, name: str, help: str, labels: Iterable[str] = (),
+                 buckets: Iterable[float] = DEFAULT_BUCKETS):
+        super().__init__(name, help, labels)
+        self._buckets = tuple(sorted(buckets)) + (float('inf'),)
+
+    def observe(self, value: float, *label_values):
+        with self._lock:
+            counts, total = self._values.get(
+                label_values, ([0] * len(self._buckets), 0.0))
+            counts[bisect.bisect_left(self._buckets, value)] += 1
+            self._values[label_values] = (counts, total + value)
+
+    @contextlib.contextmanager
+    def time(self, *label_values):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, *label_values)
+
+    def _render_value(self, label_values, value) -> Iterable[str]:
+        counts, total = value
+        names = self.label_names + ('le',)
+        cumulative = 0
+        for bucket, count in zip(self._buckets, counts):
+            cumulative += count
+            yield '{}_bucket{} {}'.format(
+                self.name,
+                _format_labels(
+                    names, label_values + (_format_value(float(bucket)),)),
+                cumulative)
+        labels = _format_labels(self.label_names, label_values)
+        yield '{}_sum{} {}'.format(self.name, labels, _format_value(total))
+        yield '{}_count{} {}'.format(self.name, labels, cumulative)
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = []
+
+    def register(self, metric: _Metric) -> _Metric:
+        self._metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+# MetricsServer serves the registry in the Prometheus text format on
+# http://host:port/metrics from a daemon thread.
+class MetricsServer:
+    def __init__(self, registry: Registry, port: int, host: str = '127.0.0.1'):
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split('?')[0] != '/metrics':
+                    self.send_error(404)
+                    return
+                body = registry.render().encode('utf-8')
+                self.send_response(200)
+                self.send_header(
+                    'Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self._server = http.server.ThreadingHTTPServer((host, port), Handler)
+        self._thread = threading.Thread(
+            target=self._server.serve_forever, daemon=True)
+
+    @property
+    def port(self) -> int:
+        return self._server.server_address[1]
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+        self._thread.join()
+
+
+ACTION_NAMES = ('TakeInventory', 'RegisterNew', 'Found', 'Discard',
+                'Investigate')
+
+
+# OroshiMetrics is what Oroshi and KintoneBookstore report to. It has the
+# same methods as oroshi.NullMetrics.
+class OroshiMetrics:
+    SCAN_RATE_WINDOW = 60
+
+    def __init__(self, registry: Registry = None, *, clock=time.monotonic):
+        self.registry = Registry() if registry is None else registry
+        self._clock = clock
+        self._scan_times = collections.deque()
+        self._scan_lock = threading.Lock()
+
+        r = self.registry
+        self.scans = r.register(Counter(
+            'oroshi_scans_total', 'Barcodes scanned.'))
+        r.register(FunctionGauge(
+            'oroshi_scans_per_second',
+            'Barcodes scanned per second over the last {} seconds.'.format(
+                self.SCAN_RATE_WINDOW),
+            self.scan_rate))
+        self.lookups_in_flight = r.register(Gauge(
+            'oroshi_lookups_in_flight', 'Record lookups in progress.'))
+        self.lookup_duration = r.register(Histogram(
+            'oroshi_lookup_duration_seconds',
+            'Time to look up the records of a chunk of ISBNs.'))
+        self.apply_duration = r.register(Histogram(
+            'oroshi_apply_duration_seconds', 'Time to apply an action.',
+            ['action']))
+        self.pending_actions = r.register(Gauge(
+            'oroshi_pending_actions',
+            'Actions decided while scanning, or selected, and not applied '
+            'yet.', ['action']))
+        self.kintone_request_duration = r.register(Histogram(
+            'kintone_request_duration_seconds',
+            'Time of a request to kintone.', ['method']))
+        self.kintone_errors = r.register(Counter(
+            'kintone_errors_total',
+            'Failed requests to kintone by kintone error code, HTTP status '
+            'or exception.', ['code']))
+
+        for name in ACTION_NAMES:
+            self.pending_actions.set(0, name)
+        self.scans.inc(amount=0)
+
+    def scanned(self):
+        now = self._clock()
+        self.scans.inc()
+        with self._scan_lock:
+            self._scan_times.append(now)
+            self._expire_scans(now)
+
+    def _expire_scans(self, now: float):
+        while (self._scan_times
+               and self._scan_times[0] <= now - self.SCAN_RATE_WINDOW):
+            self._scan_times.popleft()
+
+    def scan_rate(self) -> float:
+        with self._scan_lock:
+            self._expire_scans(self._clock())
+            return len(self._scan_times) / self.SCAN_RATE_WINDOW
+
+    @contextlib.contextmanager
+    def lookup(self):
+        self.lookups_in_flight.inc()
+        try:
+            with self.lookup_duration.time():
+                yield
+        finally:
+            self.lookups_in_flight.dec()
+
+    def decided(self, action_name: str):
+        self.pending_actions.inc(action_name)
+
+    def set_pending(self, action_names: Iterable[str]):
+        counts = collections.Counter(action_names)
+        for name in set(ACTION_NAMES) | set(counts):
+            self.pending_actions.set(counts[name], name)
+
+    @contextlib.contextmanager
+    def applying(self, action_name: str):
+        try:
+            with self.apply_duration.time(action_name):
+                yield
+        finally:
+            self.pending_actions.dec(action_name)
+
+    def install(self, kintone_app):
+        # Wraps the _request method of a pykintone application like
+        # cassette.Recorder does, to time requests and count errors.
+        request = kintone_app._request
+
+        def metered_request(method, url, params_or_data, headers=None,
+                            **kwargs):
+            try:
+                with self.kintone_request_duration.time(method.upper()):
+                    resp = request(method, url, params_or_data,
+                                   headers=headers, **kwargs)
+            except Exception as e:
+                self.kintone_errors.inc(type(e).__name__)
+                raise
+            if not resp.ok:
+                self.kintone_errors.inc(self._error_code(resp))
+            return resp
+
+        kintone_app._request = metered_request
+
+    @staticmethod
+    def _error_code(resp) -> str:
+        try:
+            return resp.json()['code']
+        except (ValueError, KeyError, TypeError):
+            return 'HTTP {}'.format(resp.status_code)
@@ -0,0 +1,310 @@
+import csv
+import os
+import sqlite3
+import threading
+from typing import Iterable, List
+
+import oroshi
+
+
+STATUS_NAMES = {
+    oroshi.RecordStatus.IN_SHELF: '本棚にあります',
+    oroshi.RecordStatus.BORROWED: 'レンタル中',
+    oroshi.RecordStatus.LOST: '紛失中',
+}
+INVENTORIED = '済み'
+
+
+class SqliteBookstore(oroshi.Bookstore):
+    SCHEMA = '''
+        CREATE TABLE IF NOT EXISTS records (
+            record_id INTEGER PRIMARY KEY AUTOINCREMENT,
+            status TEXT NOT NULL,
+            title TEXT,
+            isbn10 TEXT,
+            isbn13 TEXT,
+            "exists" TEXT,
+            inventoried INTEGER NOT NULL,
+            type TEXT,
+            revision INTEGER
+        );
+        CREATE INDEX IF NOT EXISTS records_isbn10 ON records (isbn10);
+        CREATE INDEX IF NOT EXISTS records_isbn13 ON records (isbn13);
+    '''
+    COLUMNS = ('record_id, status, title, isbn10, isbn13, "exists", '
+               'inventoried, type, revision')
+    # SQLite limits the number of host parameters in a statement.
+    MAX_PARAMS = 500
+
+    def __init__(self, path: str):
+        # Connections are shared with the worker threads of reset.
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._lock = threading.Lock()
+        with self._conn:
+            self._conn.executescript(self.SCHEMA)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self._conn.close()
+
+    @staticmethod
+    def _to_record(row) -> oroshi.BookRecord:
+        return oroshi.BookRecord(
+            record_id=row[0],
+            status=oroshi.RecordStatus[row[1]],
+            title=row[2],
+            isbn10=row[3],
+            isbn13=row[4],
+            exists=row[5],
+            inventoried=bool(row[6]),
+            type=row[7],
+            revision=row[8])
+
+    @staticmethod
+    def _to_row(record: oroshi.BookRecord) -> tuple:
+        return (record.record_id, record.status.name, record.title,
+                record.isbn10, record.isbn13, record.exists,
+                int(record.inventoried), record.type, record.revision)
+
+    def _select(self, where: str, params=()) -> List[oroshi.BookRecord]:
+        with self._lock:
+            rows = self._conn.execute(
+                'SELECT {} FROM records WHERE {}'.format(self.COLUMNS, where),
+                params).fetchall()
+        return [self._to_record(row) for row in rows]
+
+    def find_records_by_isbn(self, isbn: str) -> Iterable[oroshi.BookRecord]:
+        if len(isbn) == 10:
+            return self._select('isbn10 = ?', (isbn,))
+        elif len(isbn) == 13:
+            return self._select('isbn13 = ?', (isbn,))
+        raise ValueError('ISBN length must be 10 or 13', isbn)
+
+    def find_records_by_isbns(self, isbns: Iterable[str]) \
+            -> Iterable[oroshi.BookRecord]:
+        for chunk in oroshi.chunked(isbns, self.MAX_PARAMS // 2):
+            placeholders = ', '.join('?' * len(chunk))
+            yield from self._select(
+                'isbn10 IN ({0}) OR isbn13 IN ({0}) ORDER BY record_id'.format(
+                    placeholders),
+                chunk + chunk)
+
+    def get_record(self, record_id: int) -> oroshi.BookRecord:
+        records = self._select('record_id = ?', (record_id,))
+        return records[0] if records else None
+
+    def find_inventoried_records(self, after_id: int = 0) \
+            -> Iterable[oroshi.BookRecord]:
+        return self._select(
+            'inventoried AND record_id > ? ORDER BY record_id', (after_id,))
+
+    def add_record(self, record: oroshi.BookRecord):
+        with self._lock, self._conn:
+            cursor = self._conn.execute(
+                'INSERT INTO records ({}) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)'
+                .format(self.COLUMNS),
+                self._to_row(record._replace(record_id=None, revision=None)))
+        return cursor.lastrowid
+
+    def import_records(self, records: Iterable[oroshi.BookRecord]):
+        # Unlike add_record, keeps record_id and status of the records.
+        with self._lock, self._conn:
+            self._conn.executemany(
+                'INSERT OR REPLACE INTO records ({}) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)'.format(self.COLUMNS),
+                (self._to_row(r) for r in records))
+
+    def update_records(self, records: Iterable[oroshi.BookRecord]):
+        # Like kintone, an update never changes the status of a record. The
+        # revision is kept as exported from kintone.
+        with self._lock, self._conn:
+            for r in records:
+                cursor = self._conn.execute(
+                    'UPDATE records SET title = ?, isbn10 = ?, isbn13 = ?, '
+                    '"exists" = ?, inventoried = ?, type = ? '
+                    'WHERE record_id = ?',
+                    (r.title, r.isbn10, r.isbn13, r.exists,
+                     int(r.inventoried), r.type, r.record_id))
+                if cursor.rowcount == 0:
+                    raise RuntimeError(
+                        'not found any records with ID', r.record_id)
+
+    def update_record(self, record: oroshi.BookRecord):
+        self.update_records([record])
+
+    def clear_inventoried(self, record_ids: Iterable[int]):
+        with self._lock, self._conn:
+            self._conn.executemany(
+                'UPDATE records SET inventoried = 0 WHERE record_id = ?',
+                ((i,) for i in record_ids))
+
+    def found(self, record_id: int):
+        with self._lock, self._conn:
+            cursor = self._conn.execute(
+                'UPDATE records SET status = ? WHERE record_id = ?',
+                (oroshi.RecordStatus.IN_SHELF.name, record_id))
+        if cursor.rowcount == 0:
+            raise RuntimeError('not found any records with ID', record_id)
+
+
+# CsvBookstore reads a CSV file exported from the kintone app and writes the
+# changes back to it on close(). Columns it does not know about are kept as
+# they are so that the file can be imported to kintone again.
+#
+# The revision column is optional. Without it the records have no revision,
+# so writes queued against them cannot be checked for edits made in kintone.
+class CsvBookstore(oroshi.Bookstore):
+    RECORD_ID_COLUMNS = ('レコード番号', '$id')
+    STATUS_COLUMNS = ('ステータス', '処理状況')
+    REVISION_COLUMNS = ('$revision', 'リビジョン')
+
+    def __init__(self, path: str, *, encoding: str = 'utf-8-sig'):
+        self._path = path
+        self._encoding = encoding
+        with open(path, newline='', encoding=encoding) as f:
+            reader = csv.DictReader(f)
+            self._fieldnames = list(reader.fieldnames or [])
+            self._rows = list(reader)
+
+        self._id_column = self._find_column(self.RECORD_ID_COLUMNS)
+        self._status_column = self._find_column(self.STATUS_COLUMNS)
+        self._revision_column = next(
+            (c for c in self.REVISION_COLUMNS if c in self._fieldnames), None)
+        for column in ('title', 'isbn10', 'isbn13', 'exists', 'inventoried'):
+            if column not in self._fieldnames:
+                raise ValueError('CSV file must have the column', column)
+        if 'type' not in self._fieldnames:
+            self._fieldnames.append('type')
+
+        self._rows_by_id = {}
+        self._rows_by_isbn = {}
+        for row in self._rows:
+            self._index(row)
+        self._modified = False
+
+    def _find_column(self, candidates) -> str:
+        for column in candidates:
+            if column in self._fieldnames:
+                return column
+        raise ValueError('CSV file must have one of the columns', candidates)
+
+    def _index(self, row: dict):
+        if row[self._id_column]:
+            self._rows_by_id[int(row[self._id_column])] = row
+        for column in ('isbn10', 'isbn13'):
+            if row[column]:
+                self._rows_by_isbn.setdefault(row[column], []).append(row)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    @property
+    def has_revisions(self) -> bool:
+        return self._revision_column is not None
+
+    def close(self):
+        if self._modified:
+            self.save()
+
+    def save(self):
+        tmp_path = self._path + '.tmp'
+        with open(tmp_path, 'w', newline='', encoding=self._encoding) as f:
+            writer = csv.DictWriter(f, self._fieldnames)
+            writer.writeheader()
+            writer.writerows(self._rows)
+        os.replace(tmp_path, self._path)
+        self._modified = False
+
+    def _to_record(self, row: dict) -> oroshi.BookRecord:
+        record_id = row[self._id_column]
+        status = row[self._status_column]
+        revision = row[self._revision_column] if self.has_revisions else ''
+        return oroshi.BookRecord(
+            record_id=int(record_id) if record_id else None,
+            status=(oroshi.STATUS_MAP[status] if status
+                    else oroshi.RecordStatus.IN_SHELF),
+            title=row['title'],
+            isbn10=row['isbn10'],
+            isbn13=row['isbn13'],
+            exists=row['exists'],
+            inventoried=INVENTORIED in row['inventoried'].splitlines(),
+            type=row.get('type') or '',
+            revision=int(revision) if revision else None)
+
+    def _set_fields(self, row: dict, record: oroshi.BookRecord):
+        row['title'] = record.title
+        row['isbn10'] = record.isbn10 or ''
+        row['isbn13'] = record.isbn13 or ''
+        row['exists'] = record.exists
+        row['inventoried'] = INVENTORIED if record.inventoried else ''
+        row['type'] = record.type
+        self._modified = True
+
+    def _get_row(self, record_id: int) -> dict:
+        row = self._rows_by_id.get(record_id)
+        if row is None:
+            raise RuntimeError('not found any records with ID', record_id)
+        return row
+
+    def find_records_by_isbn(self, isbn: str) -> Iterable[oroshi.BookRecord]:
+        if len(isbn) == 10:
+            column = 'isbn10'
+        elif len(isbn) == 13:
+            column = 'isbn13'
+        else:
+            raise ValueError('ISBN length must be 10 or 13', isbn)
+        return [self._to_record(row)
+                for row in self._rows_by_isbn.get(isbn, [])
+                if row[column] == isbn]
+
+    def get_record(self, record_id: int) -> oroshi.BookRecord:
+        row = self._rows_by_id.get(record_id)
+        return self._to_record(row) if row is not None else None
+
+    def find_inventoried_records(self, after_id: int = 0) \
+            -> Iterable[oroshi.BookRecord]:
+        for record_id in sorted(self._rows_by_id):
+            record = self._to_record(self._rows_by_id[record_id])
+            if record_id > after_id and record.inventoried:
+                yield record
+
+    def add_record(self, record: oroshi.BookRecord):
+        # New records have no record number until imported to kintone.
+        row = {column: '' for column in self._fieldnames}
+        row[self._status_column] = STATUS_NAMES[oroshi.RecordStatus.IN_SHELF]
+        self._set_fields(row, record)
+        self._rows.append(row)
+        self._index(row)
+
+    def update_record(self, record: oroshi.BookRecord):
+        self._set_fields(self._get_row(record.record_id), record)
+
+    def import_records(self, records: Iterable[oroshi.BookRecord]):
+        # Like SqliteBookstore.import_records, replaces the rows which have
+        # the same record number, and keeps the status and the revision of the
+        # records.
+        for record in records:
+            row = self._rows_by_id.get(record.record_id)
+            if row is None:
+                row = {column: '' for column in self._fieldnames}
+                row[self._id_column] = str(record.record_id)
+                self._rows.append(row)
+                self._index(row)
+            row[self._status_column] = STATUS_NAMES[record.status]
+            if self.has_revisions:
+                row[self._revision_column] = (
+                    '' if record.revision is None else str(record.revision))
+            self._set_fields(row, record)
+
+    def found(self, record_id: int):
+        row = self._get_row(record_id)
+        row[self._status_column] = STATUS_NAMES[oroshi.RecordStatus.IN_SHELF]
+        self._modified = True
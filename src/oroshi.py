@@ -1,16 +1,21 @@
 # 
 import collections
+import contextlib
 import enum
 import sys
-from typing import Iterable
+from typing import Iterable, Iterator, List
 
 
+# revision is None when the bookstore does not track revisions.
 BookRecord = collections.namedtuple(
     'BookRecord',
     ['record_id', 'status', 'title', 'isbn10', 'isbn13',
-     'exists', 'inventoried', 'type'])
+     'exists', 'inventoried', 'type', 'revision'],
+    defaults=[None])
 ActionSelection = collections.namedtuple(
     'ActionSelection', ['selected', 'action'])
+# Bibliographic data of a book which is not in the bookstore yet.
+BookMetadata = collections.namedtuple('BookMetadata', ['title', 'category'])
 
 
 class RecordStatus(enum.Enum):
@@ -19,10 +24,35 @@ class RecordStatus(enum.Enum):
     LOST = 3
 
 
+# kintone status name -> RecordStatus
+STATUS_MAP = {
+    '本棚にあります': RecordStatus.IN_SHELF,
+    'レンタル中': RecordStatus.BORROWED,
+    'レンタル中(まであと一歩)': RecordStatus.BORROWED,
+    '紛失中': RecordStatus.LOST,
+}
+
+
+class RevisionConflict(RuntimeError):
+    pass
+
+
+# RecordsRejected is raised by the write methods of a bookstore when the
+# records themselves were refused, such as a field value which does not
+# validate. Sending the same records again fails the same way.
+class RecordsRejected(RuntimeError):
+    pass
+
+
 class Bookstore:
     def find_records_by_isbn(self, isbn: str) -> Iterable[BookRecord]:
         raise NotImplementedError()
 
+    def find_records_by_isbns(self, isbns: Iterable[str]) \
+            -> Iterable[BookRecord]:
+        for isbn in isbns:
+            yield from self.find_records_by_isbn(isbn)
+
     def get_record(self, record_id: int) -> BookRecord:
         raise NotImplementedError()
 
@@ -35,6 +65,39 @@ class Bookstore:
     def found(self, record_id: int):
         raise NotImplementedError()
 
+    def find_inventoried_records(self, after_id: int = 0) \
+            -> Iterable[BookRecord]:
+        # must yield records in ascending order of record_id
+        raise NotImplementedError()
+
+    def add_records(self, records: Iterable[BookRecord]):
+        for record in records:
+            self.add_record(record)
+
+    def update_records(self, records: Iterable[BookRecord]):
+        # Records with a revision must raise RevisionConflict if they were
+        # changed since that revision.
+        for record in records:
+            self.update_record(record)
+
+    def clear_inventoried(self, record_ids: Iterable[int]):
+        # Clears only the inventoried flag, so edits to the other fields made
+        # since the records were read are kept.
+        self.update_records(
+            self.get_record(i)._replace(inventoried=False, revision=None)
+            for i in record_ids)
+
+    def found_records(self, records: Iterable[BookRecord]) -> dict:
+        # returns record_id -> new revision
+        raise NotImplementedError()
+
+    def get_revisions(self, record_ids: Iterable[int]) -> dict:
+        # returns record_id -> revision for records which exist
+        raise NotImplementedError()
+
+    def close(self):
+        pass
+
 
 class Action:
     def __init__(self, record: BookRecord):
@@ -52,6 +115,14 @@ class Action:
     def isbn(self) -> str:
         return get_isbn(self._record)
 
+    @property
+    def title(self) -> str:
+        return self._record.title if self._record else 'no-title'
+
+    @property
+    def record_type(self) -> str:
+        return self._record.type if self._record else 'no-type'
+
     def act(self):
         raise NotImplementedError()
 
@@ -70,27 +141,40 @@ class TakeInventory(Action):
 
 
 class RegisterNew(Action):
-    def __init__(self, isbn: str, bookstore: Bookstore):
+    NO_TITLE = 'NO_TITLE'
+    NO_TYPE = '未分類（要変更）'
+
+    def __init__(self, isbn: str, bookstore: Bookstore,
+                 metadata: BookMetadata = None):
         super().__init__(None)
         self._isbn = isbn
         self._bookstore = bookstore
+        self._metadata = metadata or BookMetadata(None, None)
 
     def act(self):
         record = BookRecord(
             record_id=None,
             status=RecordStatus.IN_SHELF,
-            title='NO_TITLE',
+            title=self._metadata.title or self.NO_TITLE,
             isbn10=self._isbn if len(self._isbn) == 10 else None,
             isbn13=self._isbn if len(self._isbn) == 13 else None,
             exists='o',
             inventoried=True,
-            type='未分類（要変更）')
+            type=self._metadata.category or self.NO_TYPE)
         self._bookstore.add_record(record)
 
     @property
     def isbn(self) -> str:
         return self._isbn
 
+    @property
+    def title(self) -> str:
+        return self._metadata.title or super().title
+
+    @property
+    def record_type(self) -> str:
+        return self._metadata.category or super().record_type
+
 
 class Discard(Action):
     def __init__(self, record: BookRecord):
@@ -124,19 +208,59 @@ class Found(Action):
         self._bookstore.update_record(new_record)
 
 
+# NullMetrics is the default for the metrics parameters. See metrics.py for
+# the real ones.
+class NullMetrics:
+    def scanned(self):
+        pass
+
+    def lookup(self):
+        return contextlib.nullcontext()
+
+    def decided(self, action_name: str):
+        pass
+
+    def set_pending(self, action_names: Iterable[str]):
+        pass
+
+    def applying(self, action_name: str):
+        return contextlib.nullcontext()
+
+
 def log(*args, **kwargs):
     print(*args, file=sys.stderr, **kwargs)
 
 
-def read_barcodes(file=sys.stdin) -> (list, str):
-    barcodes = []
+def chunked(iterable: Iterable, size: int) -> Iterator[List]:
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def iter_barcodes(file=sys.stdin) -> Iterator[str]:
+    # The line which terminated scanning is the return value of the generator.
     for line in file:
         line = line.strip()
         if not line.isdigit() and len(line) != 13 and len(line) != 10:
-            return barcodes, line
-        barcodes.append(line)
+            return line
+        yield line
 
-    return barcodes, None
+    return None
+
+
+def read_barcodes(file=sys.stdin) -> (list, str):
+    barcodes = []
+    it = iter_barcodes(file)
+    while True:
+        try:
+            barcodes.append(next(it))
+        except StopIteration as e:
+            return barcodes, e.value
 
 
 def get_isbn(record: BookRecord) -> str:
@@ -174,35 +298,78 @@ def sort_records(records: Iterable[BookRecord]) -> Iterable[BookRecord]:
     return sorted(records, key=key)
 
 
-def decide_actions(barcodes: Iterable[str],
-                   records: Iterable[BookRecord],
-                   bookstore: Bookstore) -> Iterable[Action]:
-    isbn_record_map = split_records_by_isbn(records)
-    for isbn, records in isbn_record_map.items():
-        not_inventoried_records = [r for r in records if not r.inventoried]
-        isbn_record_map[isbn] = sort_records(not_inventoried_records)
+# ActionDecider keeps, for each ISBN, only the records which have not been
+# assigned to a barcode yet. bibindex, if given, is anything with a
+# get(isbn) -> BookMetadata method, used to fill in new records.
+class ActionDecider:
+    def __init__(self, bookstore: Bookstore, bibindex=None):
+        self._bookstore = bookstore
+        self._bibindex = bibindex
+        self._isbn_record_map = {}
+        self._looked_up_isbns = set()
+
+    def unknown_isbns(self, barcodes: Iterable[str]) -> List[str]:
+        isbns = []
+        for barcode in barcodes:
+            if barcode not in self._looked_up_isbns and barcode not in isbns:
+                isbns.append(barcode)
+        return isbns
+
+    def add_records(self, records: Iterable[BookRecord],
+                    looked_up_isbns: Iterable[str] = ()):
+        self._looked_up_isbns.update(looked_up_isbns)
+        for isbn, records in split_records_by_isbn(records).items():
+            not_inventoried_records = [r for r in records if not r.inventoried]
+            not_inventoried_records.extend(self._isbn_record_map.get(isbn, []))
+            self._isbn_record_map[isbn] = collections.deque(
+                sort_records(not_inventoried_records))
+
+    def decide(self, barcode: str) -> Action:
+        records = self._isbn_record_map.get(barcode, None)
 
-    record_actions = []
-    for barcode in barcodes:
-        records = isbn_record_map.get(barcode, None)
+        if not records:
+            metadata = self._bibindex.get(barcode) if self._bibindex else None
+            return RegisterNew(barcode, self._bookstore, metadata)
 
+        record = records.popleft()
         if not records:
-            record_actions.append(RegisterNew(barcode, bookstore))
-            continue
+            del self._isbn_record_map[barcode]
 
-        record = records.pop(0)
         if record.exists == 'x':
-            action = Discard(record)
+            return Discard(record)
         elif record.status is RecordStatus.BORROWED:
-            action = Investigate(record)
+            return Investigate(record)
         elif record.status is RecordStatus.LOST:
-            action = Found(record, bookstore)
+            return Found(record, self._bookstore)
         else:
-            action = TakeInventory(record, bookstore)
+            return TakeInventory(record, self._bookstore)
+
+
+def iter_actions(barcodes: Iterable[str], bookstore: Bookstore, *,
+                 chunk_size: int = 100, bibindex=None,
+                 metrics=None) -> Iterator[Action]:
+    # Records are looked up chunk by chunk, so actions for the first barcodes
+    # are available before the last barcodes are read.
+    metrics = NullMetrics() if metrics is None else metrics
+    decider = ActionDecider(bookstore, bibindex)
+    for chunk in chunked(barcodes, chunk_size):
+        isbns = decider.unknown_isbns(chunk)
+        if isbns:
+            with metrics.lookup():
+                records = list(bookstore.find_records_by_isbns(isbns))
+            decider.add_records(records, isbns)
+        for barcode in chunk:
+            action = decider.decide(barcode)
+            metrics.decided(action.name)
+            yield action
 
-        record_actions.append(action)
 
-    return record_actions
+def decide_actions(barcodes: Iterable[str],
+                   records: Iterable[BookRecord],
+                   bookstore: Bookstore, *, bibindex=None) -> Iterable[Action]:
+    decider = ActionDecider(bookstore, bibindex)
+    decider.add_records(records)
+    return [decider.decide(barcode) for barcode in barcodes]
 
 
 def show_action_selections(
@@ -219,12 +386,10 @@ def show_action_selections(
         'sel', 'Idx', 'Action', 'ISBN', 'Book title', 'Type'))
 
     for i, actsel in enumerate(actsels):
-        record =  actsel.action.record
-        title = record.title if record else 'no-title'
-        record_type = record.type if record else 'no-type'
+        action = actsel.action
         file.write(line_format.format(
              '[*]' if actsel.selected else '[ ]', i,
-             actsel.action.name,  actsel.action.isbn, title, record_type))
+             action.name, action.isbn, action.title, action.record_type))
 
 
 def select_actions(actions: Iterable[Action], *, stdin=None, stdout=None) \
@@ -260,24 +425,46 @@ def select_actions(actions: Iterable[Action], *, stdin=None, stdout=None) \
     return selections
 
 
+# plan_cache, if given, is a plancache.PlanCache which carries the lookups
+# and the plan over from the previous run_once, even of another process.
 class Oroshi:
-    def __init__(self, bookstore: Bookstore, *, stdin=None, stdout=None):
+    def __init__(self, bookstore: Bookstore, *, stdin=None, stdout=None,
+                 bibindex=None, metrics=None, plan_cache=None):
         self._bookstore = bookstore
+        self._bibindex = bibindex
+        self._metrics = NullMetrics() if metrics is None else metrics
+        self._plan_cache = plan_cache
         self._stdin = sys.stdin if stdin is None else stdin
         self._stdout = sys.stdout if stdout is None else stdout
 
-    def run_once(self):
-        print('Scan barcodes', file=self._stdout, flush=True)
-        barcodes, last_line = read_barcodes(self._stdin)
+    def _scan(self) -> Iterator[str]:
+        for barcode in iter_barcodes(self._stdin):
+            self._metrics.scanned()
+            yield barcode
 
-        records = []
-        for barcode in set(barcodes):
-            records.extend(self._bookstore.find_records_by_isbn(barcode))
+    def run_once(self):
+        bookstore = self._bookstore
+        if self._plan_cache:
+            bookstore = self._plan_cache.bookstore(bookstore)
 
-        actions = decide_actions(barcodes, records, self._bookstore)
+        # Actions count as pending as soon as they are decided, and only the
+        # selected ones stay pending after the selection.
+        self._metrics.set_pending([])
+        print('Scan barcodes', file=self._stdout, flush=True)
+        actions = list(iter_actions(
+            self._scan(), bookstore, bibindex=self._bibindex,
+            metrics=self._metrics))
+        if self._plan_cache:
+            for line in self._plan_cache.replan(actions):
+                print(line, file=self._stdout)
         action_selections = select_actions(
             actions, stdin=self._stdin, stdout=self._stdout)
-        for actsel in action_selections:
-            if not actsel.selected:
-                continue
-            actsel.action.act()
+        selected_actions = [s.action for s in action_selections if s.selected]
+        self._metrics.set_pending(a.name for a in selected_actions)
+        try:
+            for action in selected_actions:
+                with self._metrics.applying(action.name):
+                    action.act()
+        finally:
+            if self._plan_cache:
+                self._plan_cache.applied()
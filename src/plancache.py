@@ -0,0 +1,233 @@
+import collections
+import json
+import os
+import time
+from typing import Iterable, List
+
+import oroshi
+import writebehind
+
+
+# PlanEntry is one action of a plan, as much of it as is shown to the
+# operator.
+PlanEntry = collections.namedtuple(
+    'PlanEntry', ['name', 'isbn', 'record_id', 'title', 'record_type'])
+
+MAX_AGE = 60 * 60
+
+
+def plan_entry(action: oroshi.Action) -> PlanEntry:
+    record_id = action.record.record_id if action.record else None
+    return PlanEntry(action.name, action.isbn, record_id, action.title,
+                     action.record_type)
+
+
+def diff_plans(old: Iterable[PlanEntry], new: Iterable[PlanEntry]) \
+        -> (List[PlanEntry], List[PlanEntry]):
+    # Returns (removed, added). Plans are compared as multisets, so the order
+    # in which the books were scanned does not matter.
+    old = list(old)
+    new = list(new)
+    removed = collections.Counter(old) - collections.Counter(new)
+    added = collections.Counter(new) - collections.Counter(old)
+    return (_take(old, removed), _take(new, added))
+
+
+def _take(entries: List[PlanEntry], counts: collections.Counter) \
+        -> List[PlanEntry]:
+    result = []
+    for entry in entries:
+        if counts[entry] > 0:
+            counts[entry] -= 1
+            result.append(entry)
+    return result
+
+
+def format_plan_diff(removed: List[PlanEntry], added: List[PlanEntry]) \
+        -> List[str]:
+    if not removed and not added:
+        return ['Same plan as the previous session']
+    lines = ['Changes from the previous session: {} removed, {} added'.format(
+        len(removed), len(added))]
+    entries = [('-', e) for e in removed] + [('+', e) for e in added]
+    name_max = max(len(e.name) for _, e in entries)
+    isbn_max = max(len(e.isbn) for _, e in entries)
+    line_format = ('  {} {:' + str(name_max) + '}  {:' + str(isbn_max)
+                   + '}  {} ({})')
+    for sign, e in entries:
+        lines.append(line_format.format(
+            sign, e.name, e.isbn, e.title, e.record_type))
+    return lines
+
+
+# PlanCache keeps, between sessions, the records looked up for each scanned
+# ISBN and the plan which was shown to the operator. The file is written
+# before the operator is asked to select actions, because "quit" exits
+# without returning.
+#
+# Cached records are checked against their revisions once per session, so an
+# ISBN is looked up again only if it is new or one of its records was edited.
+# ISBNs without any records are not cached: they become RegisterNew, which
+# would add a duplicate if someone else had registered the book meanwhile.
+# A record added by someone else to an ISBN which has other records is not
+# noticed, which is why the cache expires after max_age seconds.
+class PlanCache:
+    def __init__(self, path: str, *, max_age: float = MAX_AGE,
+                 clock=time.time):
+        self._path = path
+        self._clock = clock
+        # isbn -> list of records
+        self._records = {}
+        self._plan = None
+        try:
+            with open(path, encoding='utf-8') as f:
+                body = json.load(f)
+        except FileNotFoundError:
+            return
+        if clock() - body['saved_at'] > max_age:
+            return
+        self._records = {
+            isbn: [writebehind.record_from_dict(r) for r in records]
+            for isbn, records in body['records'].items()}
+        if body['plan'] is not None:
+            self._plan = [PlanEntry(*e) for e in body['plan']]
+
+    def save(self):
+        body = {
+            'saved_at': self._clock(),
+            'records': {
+                isbn: [writebehind.record_to_dict(r) for r in records]
+                for isbn, records in self._records.items()},
+            'plan': (None if self._plan is None
+                     else [list(e) for e in self._plan]),
+        }
+        tmp_path = self._path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(body, f, ensure_ascii=False)
+        os.replace(tmp_path, self._path)
+
+    def bookstore(self, bookstore: oroshi.Bookstore) -> 'CachingBookstore':
+        return CachingBookstore(bookstore, self)
+
+    def replan(self, actions: Iterable[oroshi.Action]) -> List[str]:
+        # Saves the plan made of actions, and returns the lines which show
+        # how it differs from the previous one, or no lines if there is none.
+        old_plan = self._plan
+        self._plan = [plan_entry(a) for a in actions]
+        self.save()
+        if old_plan is None:
+            return []
+        return format_plan_diff(*diff_plans(old_plan, self._plan))
+
+    def applied(self):
+        # The plan was carried out, so the next one is not compared with it.
+        self._plan = None
+        self.save()
+
+    def get(self, isbn: str) -> List[oroshi.BookRecord]:
+        return self._records.get(isbn)
+
+    def put(self, isbns: Iterable[str],
+            records: Iterable[oroshi.BookRecord]):
+        records = list(records)
+        for isbn in isbns:
+            matched = [r for r in records if isbn in (r.isbn10, r.isbn13)]
+            # Records without a revision, such as additions waiting in the
+            # write queue, cannot be checked later, and neither can the
+            # absence of records.
+            if matched and all(r.revision is not None for r in matched):
+                self._records[isbn] = matched
+
+    def forget_isbn(self, isbn: str):
+        self._records.pop(isbn, None)
+
+    def forget_record(self, record: oroshi.BookRecord):
+        for isbn in (record.isbn10, record.isbn13):
+            if isbn:
+                self.forget_isbn(isbn)
+        if record.record_id is not None:
+            self.forget_record_id(record.record_id)
+
+    def forget_record_id(self, record_id: int):
+        for isbn, records in list(self._records.items()):
+            if any(r.record_id == record_id for r in records):
+                del self._records[isbn]
+
+    def validate(self, bookstore: oroshi.Bookstore) -> int:
+        # Forgets the ISBNs any record of which was edited or deleted, and
+        # returns how many ISBNs are left.
+        expected = {r.record_id: r.revision
+                    for records in self._records.values() for r in records}
+        if not expected:
+            return len(self._records)
+        try:
+            revisions = bookstore.get_revisions(expected)
+        except NotImplementedError:
+            self._records = {}
+            return 0
+        changed = {record_id for record_id, revision in expected.items()
+                   if revisions.get(record_id) != revision}
+        for record_id in changed:
+            self.forget_record_id(record_id)
+        return len(self._records)
+
+
+# CachingBookstore looks up the ISBNs which are not in the cache only, and
+# forgets the ISBNs it writes to, so that the written records are looked up
+# again in the next session.
+class CachingBookstore(oroshi.Bookstore):
+    def __init__(self, bookstore: oroshi.Bookstore, cache: PlanCache):
+        self._bookstore = bookstore
+        self._cache = cache
+        self._validated = False
+
+    def find_records_by_isbn(self, isbn: str) -> Iterable[oroshi.BookRecord]:
+        return self.find_records_by_isbns([isbn])
+
+    def find_records_by_isbns(self, isbns: Iterable[str]) \
+            -> Iterable[oroshi.BookRecord]:
+        if not self._validated:
+            self._cache.validate(self._bookstore)
+            self._validated = True
+
+        missing = []
+        # A record is cached under both its ISBN-10 and ISBN-13.
+        seen = set()
+        for isbn in isbns:
+            records = self._cache.get(isbn)
+            if records is None:
+                missing.append(isbn)
+                continue
+            for record in records:
+                if record.record_id not in seen:
+                    seen.add(record.record_id)
+                    yield record
+        if missing:
+            records = list(self._bookstore.find_records_by_isbns(missing))
+            self._cache.put(missing, records)
+            yield from records
+
+    def get_record(self, record_id: int) -> oroshi.BookRecord:
+        return self._bookstore.get_record(record_id)
+
+    def add_record(self, record: oroshi.BookRecord):
+        self._cache.forget_record(record)
+        self._bookstore.add_record(record)
+
+    def update_record(self, record: oroshi.BookRecord):
+        self._cache.forget_record(record)
+        self._bookstore.update_record(record)
+
+    def found(self, record_id: int):
+        self._cache.forget_record_id(record_id)
+        self._bookstore.found(record_id)
+
+    def find_inventoried_records(self, after_id: int = 0) \
+            -> Iterable[oroshi.BookRecord]:
+        return self._bookstore.find_inventoried_records(after_id)
+
+    def get_revisions(self, record_ids: Iterable[int]) -> dict:
+        return self._bookstore.get_revisions(record_ids)
+
+    def close(self):
+        self._bookstore.close()
@@ -0,0 +1,129 @@
+import collections
+import concurrent.futures
+import os
+import time
+
+import oroshi
+
+
+# Checkpoint keeps the largest record ID up to which every record is done,
+# and when the reset which saved it was started.
+class Checkpoint:
+    def __init__(self, path: str):
+        self._path = path
+
+    def _read(self) -> list:
+        try:
+            with open(self._path) as f:
+                return f.read().split()
+        except FileNotFoundError:
+            return []
+
+    def load(self) -> int:
+        fields = self._read()
+        return int(fields[0]) if fields else 0
+
+    def started_at(self) -> float:
+        # Checkpoints saved before the start time was kept have none.
+        fields = self._read()
+        return float(fields[1]) if len(fields) > 1 else None
+
+    def save(self, record_id: int, started_at: float = None):
+        tmp_path = self._path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            f.write('{}\n'.format(record_id))
+            if started_at is not None:
+                f.write('{}\n'.format(started_at))
+        os.replace(tmp_path, self._path)
+
+    def clear(self):
+        try:
+            os.remove(self._path)
+        except FileNotFoundError:
+            pass
+
+
+# InterruptedReset is raised when a checkpoint is left by a reset which did
+# not finish, and resuming it was not asked for. The checkpoint may be from
+# a past season, and resuming it would skip every record up to it.
+class InterruptedReset(RuntimeError):
+    pass
+
+
+# InventoryResetter clears the inventoried flag of every record.
+# At most `workers` batches are in flight at the same time, which keeps the
+# number of concurrent requests to kintone bounded.
+class InventoryResetter:
+    def __init__(self, bookstore: oroshi.Bookstore, *,
+                 batch_size: int = 100, workers: int = 4,
+                 checkpoint: Checkpoint = None, resume: bool = False,
+                 progress=None):
+        if batch_size < 1 or workers < 1:
+            raise ValueError('batch_size and workers must be positive',
+                             batch_size, workers)
+        self._bookstore = bookstore
+        self._batch_size = batch_size
+        self._workers = workers
+        self._checkpoint = checkpoint
+        self._resume = resume
+        self._progress = oroshi.log if progress is None else progress
+
+    def run(self) -> int:
+        after_id = self._checkpoint.load() if self._checkpoint else 0
+        self._started_at = time.time()
+        if after_id > 0:
+            started_at = self._checkpoint.started_at()
+            if not self._resume:
+                raise InterruptedReset(
+                    'a reset started at {} stopped after record {}'.format(
+                        _format_time(started_at), after_id))
+            self._progress('resuming the reset started at {} after record {}'
+                           .format(_format_time(started_at), after_id))
+            if started_at is not None:
+                self._started_at = started_at
+
+        records = self._bookstore.find_inventoried_records(after_id)
+        # Only the flag is written, so a record edited since it was read
+        # keeps the edit and needs no revision check.
+        batches = oroshi.chunked(
+            (r.record_id for r in records), self._batch_size)
+
+        # Batches are completed in the order they were submitted so that the
+        # checkpoint never skips over a batch that is still in flight.
+        pending = collections.deque()
+        num_reset = 0
+        with concurrent.futures.ThreadPoolExecutor(
+                max_workers=self._workers) as executor:
+            try:
+                for batch in batches:
+                    future = executor.submit(
+                        self._bookstore.clear_inventoried, batch)
+                    pending.append((future, batch))
+                    if len(pending) >= self._workers:
+                        num_reset += self._complete(*pending.popleft(), num_reset)
+                while pending:
+                    num_reset += self._complete(*pending.popleft(), num_reset)
+            except BaseException:
+                for future, _ in pending:
+                    future.cancel()
+                raise
+
+        if self._checkpoint:
+            self._checkpoint.clear()
+        self._progress('done: reset {} records'.format(num_reset))
+        return num_reset
+
+    def _complete(self, future, batch, num_reset: int) -> int:
+        future.result()
+        last_id = batch[-1]
+        if self._checkpoint:
+            self._checkpoint.save(last_id, self._started_at)
+        self._progress('reset {} records (up to record {})'.format(
+            num_reset + len(batch), last_id))
+        return len(batch)
+
+
+def _format_time(t: float) -> str:
+    if t is None:
+        return 'an unknown time'
+    return time.strftime('%Y-%m-%d %H:%M', time.localtime(t))
@@ -0,0 +1,148 @@
+import io
+import json
+import os
+import tempfile
+import unittest
+
+import bibindex
+import oroshi
+from fakes import ISBN1, ISBN2, ISBN3
+
+
+ISBN3_13 = '9784810180770'
+
+
+class IsbnTest(unittest.TestCase):
+    def test_isbn10_to_isbn13(self):
+        self.assertEqual(bibindex.isbn10_to_isbn13(ISBN3), ISBN3_13)
+        self.assertEqual(
+            bibindex.isbn10_to_isbn13('480711808X'), '9784807118083')
+
+    def test_normalize_isbn(self):
+        self.assertEqual(bibindex.normalize_isbn('978-4-7898-4994-4'), ISBN1)
+        self.assertEqual(bibindex.normalize_isbn(ISBN3), ISBN3_13)
+        self.assertIsNone(bibindex.normalize_isbn('hogera'))
+
+
+class BibIndexTest(unittest.TestCase):
+    def setUp(self):
+        self._dir = tempfile.TemporaryDirectory()
+        self._path = os.path.join(self._dir.name, 'books.bibindex')
+
+    def tearDown(self):
+        self._dir.cleanup()
+
+    def test_build_and_get(self):
+        n = bibindex.build_index([
+            (ISBN2, 'book2', 'UI'),
+            (ISBN1, 'book1', ''),
+            (ISBN3, '本3', 'OS'),
+            (ISBN1, 'duplicated', ''),
+            ('hogera', 'invalid', ''),
+        ], self._path)
+        self.assertEqual(n, 3)
+
+        with bibindex.BibIndex(self._path) as index:
+            self.assertEqual(len(index), 3)
+            self.assertEqual(
+                index.get(ISBN1), oroshi.BookMetadata('book1', None))
+            self.assertEqual(index.get(ISBN2), oroshi.BookMetadata('book2', 'UI'))
+            # ISBN-10 でも ISBN-13 でも引ける
+            self.assertEqual(index.get(ISBN3), oroshi.BookMetadata('本3', 'OS'))
+            self.assertEqual(index.get(ISBN3_13).title, '本3')
+            self.assertIsNone(index.get('9780000000002'))
+            self.assertIsNone(index.get('9999999999999'))
+            self.assertIsNone(index.get('hogera'))
+
+    def test_many_entries(self):
+        isbns = ['978{:010}'.format(i * 7) for i in range(5000)]
+        bibindex.build_index(
+            ((isbn, 'book' + isbn, '') for isbn in reversed(isbns)), self._path)
+
+        with bibindex.BibIndex(self._path) as index:
+            for isbn in isbns[::97]:
+                self.assertEqual(index.get(isbn).title, 'book' + isbn)
+            self.assertIsNone(index.get('978{:010}'.format(1)))
+
+    def test_many_runs(self):
+        # 索引は小さな単位で整列してから併合して作る
+        isbns = ['978{:010}'.format(i * 7) for i in range(1000)]
+        entries = [(isbn, 'book' + isbn, '') for isbn in reversed(isbns)]
+        entries += [(isbn, 'duplicated', '') for isbn in isbns[::3]]
+        n = bibindex.build_index(entries, self._path, run_size=64)
+        self.assertEqual(n, 1000)
+
+        with bibindex.BibIndex(self._path) as index:
+            for isbn in isbns:
+                self.assertEqual(index.get(isbn).title, 'book' + isbn)
+        self.assertEqual(os.listdir(self._dir.name), ['books.bibindex'])
+
+    def test_empty(self):
+        bibindex.build_index([], self._path)
+        with bibindex.BibIndex(self._path) as index:
+            self.assertIsNone(index.get(ISBN1))
+
+    def test_not_an_index(self):
+        with open(self._path, 'wb') as f:
+            f.write(b'0' * 32)
+        with self.assertRaises(ValueError):
+            bibindex.BibIndex(self._path)
+
+
+class ReaderTest(unittest.TestCase):
+    def test_read_tsv(self):
+        inp = io.StringIO('{}\tbook1\tUI\n{}\tbook2\n\n'.format(ISBN1, ISBN2))
+        self.assertEqual(
+            list(bibindex.read_tsv(inp)),
+            [(ISBN1, 'book1', 'UI'), (ISBN2, 'book2', '')])
+
+    def test_read_openbd(self):
+        books = [{'summary': {'isbn': ISBN1, 'title': 'book1'}}, None,
+                 {'summary': {'isbn': ISBN2, 'title': 'book2'}}]
+        expected = [(ISBN1, 'book1', ''), (ISBN2, 'book2', '')]
+
+        inp = io.StringIO(json.dumps(books))
+        self.assertEqual(list(bibindex.read_openbd(inp)), expected)
+
+        inp = io.StringIO('\n'.join(json.dumps(b) for b in books))
+        self.assertEqual(list(bibindex.read_openbd(inp)), expected)
+
+    def test_read_openbd_in_chunks(self):
+        books = [{'summary': {'isbn': '978{:010}'.format(i),
+                              'title': '本{}'.format(i)}}
+                 for i in range(100)]
+        books.insert(50, None)
+        inp = io.StringIO(json.dumps(books, ensure_ascii=False, indent=1))
+        self.assertEqual(
+            list(bibindex.read_openbd(inp, chunk_size=7)),
+            [('978{:010}'.format(i), '本{}'.format(i), '') for i in range(100)])
+
+    def test_read_openbd_pretty_printed(self):
+        books = [{'summary': {'isbn': ISBN1, 'title': 'book1'}}]
+        expected = [(ISBN1, 'book1', '')]
+
+        inp = io.StringIO('\n' + json.dumps(books, indent=2))
+        self.assertEqual(list(bibindex.read_openbd(inp)), expected)
+
+        # BOM 付きでも読める
+        inp = io.StringIO('\ufeff  ' + json.dumps(books, indent=2))
+        self.assertEqual(list(bibindex.read_openbd(inp)), expected)
+        inp = io.StringIO('\ufeff' + json.dumps(books[0]) + '\n')
+        self.assertEqual(list(bibindex.read_openbd(inp)), expected)
+
+    def test_build_index_from_file(self):
+        with tempfile.TemporaryDirectory() as d:
+            dump_path = os.path.join(d, 'openbd.json')
+            with open(dump_path, 'w', encoding='utf-8-sig') as f:
+                json.dump([{'summary': {'isbn': ISBN1, 'title': '本1'}}], f,
+                          ensure_ascii=False, indent=2)
+            index_path = os.path.join(d, 'books.bibindex')
+            self.assertEqual(
+                bibindex.build_index_from_file(dump_path, index_path), 1)
+            with bibindex.BibIndex(index_path) as index:
+                self.assertEqual(index.get(ISBN1).title, '本1')
+
+    def test_read_openbd_broken(self):
+        inp = io.StringIO('[{"summary": {"isbn": "%s"}}, {"summary"' % ISBN1)
+        with self.assertRaises(ValueError):
+            list(bibindex.read_openbd(inp, chunk_size=4))
@@ -0,0 +1,170 @@
+import io
+import json
+import os
+import tempfile
+import types
+import unittest
+
+import cassette
+
+
+URL = 'https://example.cybozu.com/k/v1/records.json'
+TOKEN = 'secret-api-token'
+
+
+# FakeApp has the part of pykintone.application.Application which cassette
+# uses.
+class FakeApp:
+    def __init__(self):
+        self.account = types.SimpleNamespace(domain='example')
+        self.app_id = 42
+        self.requests = []
+
+    def _request(self, method, url, params_or_data, headers=None,
+                 use_api_token=True):
+        self.requests.append((method, url, params_or_data))
+        body = {'records': [], 'query': params_or_data.get('query')}
+        return cassette.FakeResponse(200, json.dumps(body))
+
+
+def select(app, query):
+    headers = {'X-Cybozu-API-Token': TOKEN, 'Host': 'example.cybozu.com:443'}
+    resp = app._request('POST', URL, {'app': app.app_id, 'query': query},
+                        headers=headers)
+    return resp.json()
+
+
+class CassetteTest(unittest.TestCase):
+    def setUp(self):
+        self._dir = tempfile.TemporaryDirectory()
+        self._path = os.path.join(self._dir.name, 'session.cassette')
+
+    def tearDown(self):
+        self._dir.cleanup()
+
+    def record(self, queries, input_text=''):
+        app = FakeApp()
+        recorder = cassette.Recorder(cassette.Cassette())
+        recorder.install(app)
+        stdin = recorder.input(io.StringIO(input_text))
+        for line in stdin:
+            pass
+        for query in queries:
+            select(app, query)
+        recorder.cassette.save(self._path)
+        return recorder
+
+    def test_record(self):
+        recorder = self.record(['isbn13 = "1"', 'isbn13 = "2"'])
+
+        stats = recorder.stats()
+        self.assertEqual(stats.calls, 2)
+        self.assertGreater(stats.bytes_sent, 0)
+        self.assertGreater(stats.bytes_received, 0)
+
+        with open(self._path, encoding='utf-8') as f:
+            text = f.read()
+        # API トークンは記録しない
+        self.assertNotIn(TOKEN, text)
+        self.assertIn(cassette.REDACTED, text)
+
+    def test_replay(self):
+        self.record(['isbn13 = "1"', 'isbn13 = "2"'], input_text='1\n2\ndo\n')
+
+        loaded = cassette.Cassette.load(self._path)
+        sleeps = []
+        player = cassette.Player(loaded, time_scale=2.0, sleep=sleeps.append)
+        app = FakeApp()
+        player.install(app)
+
+        self.assertEqual(select(app, 'isbn13 = "2"')['query'], 'isbn13 = "2"')
+        self.assertEqual(select(app, 'isbn13 = "1"')['query'], 'isbn13 = "1"')
+        # kintone には接続しない
+        self.assertEqual(app.requests, [])
+        self.assertEqual(player.num_unused(), 0)
+        self.assertEqual(player.differences(), [])
+        self.assertEqual(player.stats()[:3], loaded.stats()[:3])
+        self.assertEqual(
+            sleeps, [2.0 * loaded.exchanges[1].elapsed,
+                     2.0 * loaded.exchanges[0].elapsed])
+        self.assertEqual(player.input().read(), '1\n2\ndo\n')
+
+    def test_replay_without_waiting(self):
+        self.record(['isbn13 = "1"'])
+        sleeps = []
+        loaded = cassette.Cassette.load(self._path)
+        player = cassette.Player(loaded, time_scale=0, sleep=sleeps.append)
+        app = FakeApp()
+        player.install(app)
+
+        select(app, 'isbn13 = "1"')
+        self.assertEqual(sleeps, [])
+        self.assertEqual(player.stats(), loaded.stats())
+
+    def test_replay_measures_time(self):
+        loaded = cassette.Cassette([cassette.Exchange(
+            'POST', URL, {}, cassette.encode_request({'query': 'q'}), 200,
+            '{}', 0.05)])
+        player = cassette.Player(loaded)
+        app = FakeApp()
+        player.install(app)
+
+        app._request('POST', URL, {'query': 'q'})
+        self.assertGreaterEqual(player.stats().wall_time, 0.05)
+
+    def test_replay_changed_requests(self):
+        self.record(['isbn13 in ("1", "2")', 'isbn13 in ("3")'])
+        player = cassette.Player(
+            cassette.Cassette.load(self._path), time_scale=0)
+        app = FakeApp()
+        player.install(app)
+
+        # 問い合わせの組み立て方を変えても失敗せず、違いとして報告する
+        select(app, 'isbn13 in ("1", "2", "3")')
+        select(app, 'isbn13 = "4"')
+        select(app, 'isbn13 = "5"')
+        response = app._request('GET', URL + '?unknown', {})
+
+        self.assertEqual(response.status_code, 404)
+        differences = player.differences()
+        self.assertEqual(
+            [d.split(':')[0] for d in differences],
+            ['changed', 'new', 'new', 'new'])
+        self.assertIn('isbn13 in (\\"1\\", \\"2\\", \\"3\\")', differences[0])
+
+        # 記録より多く呼び出したら回帰として報告する
+        regressions = cassette.compare_stats(
+            player.stats(), player.cassette.stats())
+        self.assertTrue(any('calls' in r for r in regressions))
+
+    def test_replay_not_sent(self):
+        self.record(['isbn13 = "1"', 'isbn13 = "2"'])
+        player = cassette.Player(
+            cassette.Cassette.load(self._path), time_scale=0)
+        app = FakeApp()
+        player.install(app)
+
+        select(app, 'isbn13 = "2"')
+        differences = player.differences()
+        self.assertEqual(len(differences), 1)
+        self.assertTrue(differences[0].startswith('not sent:'))
+        self.assertIn('isbn13 = \\"1\\"', differences[0])
+
+    def test_request_shape(self):
+        self.assertEqual(
+            cassette.request_shape({'app': 1, 'query': 'isbn13 in ("1", "2")'}),
+            cassette.request_shape({'app': 2, 'query': 'isbn13 in ("3")'}))
+        self.assertNotEqual(
+            cassette.request_shape({'app': 1, 'query': 'isbn13 in ("1")'}),
+            cassette.request_shape({'app': 1, 'query': 'isbn10 in ("1")'}))
+
+    def test_compare_stats(self):
+        baseline = cassette.Stats(10, 1000, 5000, 2.0)
+        self.assertEqual(
+            cassette.compare_stats(cassette.Stats(10, 1050, 4000, 1.0), baseline),
+            [])
+
+        regressions = cassette.compare_stats(
+            cassette.Stats(20, 1000, 5000, 2.0), baseline)
+        self.assertEqual(len(regressions), 1)
+        self.assertIn('calls', regressions[0])
@@ -0,0 +1,120 @@
+import os
+import unittest
+
+import pykintone
+
+import cassette
+import main
+import oroshi
+from fakes import ISBN1, ISBN2, ISBN3
+
+
+TESTDATA = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'testdata')
+
+
+# The cassettes in testdata are the requests which KintoneBookstore sends,
+# answered as kintone does. A test fails if the requests change, so that a
+# change in how KintoneBookstore talks to kintone is made on purpose, with
+# the cassettes updated along with it.
+class KintoneBookstoreTest(unittest.TestCase):
+    def replay(self, name: str) -> main.KintoneBookstore:
+        loaded = cassette.Cassette.load(
+            os.path.join(TESTDATA, name + '.cassette'))
+        self._player = cassette.Player(loaded, time_scale=0)
+        app = pykintone.app(loaded.app['domain'], loaded.app['app_id'], '')
+        self._player.install(app)
+        return main.KintoneBookstore(app)
+
+    def assertCalls(self, calls: int):
+        self.assertEqual(self._player.differences(), [])
+        self.assertEqual(self._player.stats().calls, calls)
+
+    def test_find_records_by_isbns(self):
+        bookstore = self.replay('find_records_by_isbns')
+        records = list(bookstore.find_records_by_isbns([ISBN1, ISBN3, ISBN2]))
+
+        # ISBN-10 と ISBN-13 をまとめて一度に検索する
+        self.assertCalls(1)
+        self.assertEqual([r.record_id for r in records], [1, 2, 22, 31])
+        record = records[2]
+        self.assertEqual(record.status, oroshi.RecordStatus.LOST)
+        self.assertFalse(record.inventoried)
+        self.assertEqual(record.revision, 7)
+        self.assertTrue(records[0].inventoried)
+
+    def test_select_all_paged(self):
+        bookstore = self.replay('select_all_paged')
+        bookstore.SELECT_LIMIT = 2
+        records = list(bookstore.find_records_by_isbns([ISBN1, ISBN2]))
+
+        self.assertCalls(3)
+        self.assertEqual([r.record_id for r in records], [1, 2, 22, 40])
+
+    def test_find_all_records(self):
+        bookstore = self.replay('cursor')
+        bookstore.CURSOR_SIZE = 2
+        records = list(bookstore.find_all_records())
+
+        # カーソルの作成と 3 回の読み出し。読み終えたカーソルは消さなくてよい
+        self.assertCalls(4)
+        self.assertEqual([r.record_id for r in records], [1, 2, 22, 31, 40])
+
+    def test_abandoned_cursor_is_deleted(self):
+        bookstore = self.replay('cursor_abandoned')
+        bookstore.CURSOR_SIZE = 2
+        records = bookstore.find_inventoried_records(0)
+        self.assertEqual(next(records).record_id, 1)
+        records.close()
+
+        self.assertCalls(3)
+
+    def test_get_revisions(self):
+        bookstore = self.replay('get_revisions')
+        self.assertEqual(bookstore.get_revisions([2, 22, 99]), {2: 6, 22: 7})
+        self.assertCalls(1)
+
+    def test_add_records(self):
+        bookstore = self.replay('add_records')
+        records = [oroshi.BookRecord(
+            None, oroshi.RecordStatus.IN_SHELF, 'NO_TITLE', None,
+            '978{:010}'.format(i), 'o', True, '未分類（要変更）')
+            for i in range(101)]
+        bookstore.add_records(records)
+
+        # 100 件ずつ一括で追加する
+        self.assertCalls(2)
+
+    def test_update_records_conflict(self):
+        records = list(self.replay('find_records_by_isbns')
+                       .find_records_by_isbns([ISBN1, ISBN3, ISBN2]))
+        bookstore = self.replay('update_records_conflict')
+
+        with self.assertRaises(oroshi.RevisionConflict):
+            bookstore.update_records(
+                [r._replace(inventoried=True) for r in records[1:3]])
+        self.assertCalls(1)
+
+    def test_update_records_rejected(self):
+        records = list(self.replay('find_records_by_isbns')
+                       .find_records_by_isbns([ISBN1, ISBN3, ISBN2]))
+        bookstore = self.replay('update_records_rejected')
+
+        # 入力値のエラーは、送り直しても通らない
+        with self.assertRaises(oroshi.RecordsRejected):
+            bookstore.update_records(
+                [r._replace(inventoried=True) for r in records[1:3]])
+        self.assertCalls(1)
+
+    def test_found_records(self):
+        records = list(self.replay('find_records_by_isbns')
+                       .find_records_by_isbns([ISBN1, ISBN3, ISBN2]))
+        bookstore = self.replay('found_records')
+
+        self.assertEqual(bookstore.found_records([records[2]]), {22: 9})
+        self.assertCalls(1)
+
+    def test_clear_inventoried(self):
+        bookstore = self.replay('clear_inventoried')
+        bookstore.clear_inventoried([1, 40])
+        # inventoried 以外のフィールドは送らない
+        self.assertCalls(1)
@@ -0,0 +1,157 @@
+import json
+import unittest
+import urllib.error
+import urllib.request
+
+import cassette
+import metrics
+
+
+# FakeApp answers every request with the given status and body.
+class FakeApp:
+    def __init__(self, status=200, text='{}'):
+        self._status = status
+        self._text = text
+
+    def _request(self, method, url, params_or_data, headers=None,
+                 use_api_token=True):
+        return cassette.FakeResponse(self._status, self._text)
+
+
+class FailingApp:
+    def _request(self, method, url, params_or_data, headers=None,
+                 use_api_token=True):
+        raise ConnectionError('unreachable')
+
+
+class MetricsTest(unittest.TestCase):
+    def test_render(self):
+        registry = metrics.Registry()
+        counter = registry.register(
+            metrics.Counter('requests_total', 'Requests.', ['code']))
+        counter.inc('200')
+        counter.inc('200')
+        counter.inc('GAIA "X"')
+
+        self.assertEqual(registry.render(), '\n'.join([
+            '# HELP requests_total Requests.',
+            '# TYPE requests_total counter',
+            'requests_total{code="200"} 2',
+            'requests_total{code="GAIA \\"X\\""} 1',
+        ]) + '\n')
+
+    def test_histogram(self):
+        histogram = metrics.Histogram('t', 'Time.', buckets=[0.1, 1])
+        histogram.observe(0.05)
+        histogram.observe(0.1)
+        histogram.observe(0.5)
+        histogram.observe(3)
+
+        self.assertEqual(list(histogram.render())[2:], [
+            't_bucket{le="0.1"} 2',
+            't_bucket{le="1.0"} 3',
+            't_bucket{le="+Inf"} 4',
+            't_sum 3.65',
+            't_count 4',
+        ])
+
+    def test_scan_rate(self):
+        now = [0.0]
+        m = metrics.OroshiMetrics(clock=lambda: now[0])
+        for t in range(30):
+            now[0] = float(t)
+            m.scanned()
+        self.assertEqual(m.scan_rate(), 30 / m.SCAN_RATE_WINDOW)
+
+        now[0] = 75.0
+        self.assertEqual(m.scan_rate(), 14 / m.SCAN_RATE_WINDOW)
+        self.assertIn('oroshi_scans_total 30', m.registry.render())
+
+    def test_pending_actions(self):
+        m = metrics.OroshiMetrics()
+        m.set_pending(['Found', 'TakeInventory', 'TakeInventory'])
+        with m.applying('TakeInventory'):
+            pass
+
+        text = m.registry.render()
+        self.assertIn('oroshi_pending_actions{action="TakeInventory"} 1', text)
+        self.assertIn('oroshi_pending_actions{action="Found"} 1', text)
+        self.assertIn('oroshi_pending_actions{action="Discard"} 0', text)
+        self.assertIn(
+            'oroshi_apply_duration_seconds_count{action="TakeInventory"} 1',
+            text)
+
+    def test_pending_while_scanning(self):
+        m = metrics.OroshiMetrics()
+        m.decided('Found')
+        m.decided('RegisterNew')
+        m.decided('RegisterNew')
+        text = m.registry.render()
+        self.assertIn('oroshi_pending_actions{action="RegisterNew"} 2', text)
+        self.assertIn('oroshi_pending_actions{action="Found"} 1', text)
+
+        # 選ばれなかったアクションは減る
+        m.set_pending(['RegisterNew'])
+        text = m.registry.render()
+        self.assertIn('oroshi_pending_actions{action="RegisterNew"} 1', text)
+        self.assertIn('oroshi_pending_actions{action="Found"} 0', text)
+
+    def test_lookup(self):
+        m = metrics.OroshiMetrics()
+        with m.lookup():
+            self.assertIn('oroshi_lookups_in_flight 1', m.registry.render())
+        text = m.registry.render()
+        self.assertIn('oroshi_lookups_in_flight 0', text)
+        self.assertIn('oroshi_lookup_duration_seconds_count 1', text)
+
+    def test_install(self):
+        m = metrics.OroshiMetrics()
+        ok_app = FakeApp()
+        conflict_app = FakeApp(
+            409, json.dumps({'code': 'GAIA_CO02', 'message': ''}))
+        proxy_app = FakeApp(502, '<html>Bad Gateway</html>')
+        failing_app = FailingApp()
+        for app in (ok_app, conflict_app, proxy_app, failing_app):
+            m.install(app)
+
+        ok_app._request('GET', 'url', {})
+        conflict_app._request('put', 'url', {})
+        proxy_app._request('GET', 'url', {})
+        with self.assertRaises(ConnectionError):
+            failing_app._request('GET', 'url', {})
+
+        text = m.registry.render()
+        self.assertIn(
+            'kintone_request_duration_seconds_count{method="GET"} 3', text)
+        self.assertIn(
+            'kintone_request_duration_seconds_count{method="PUT"} 1', text)
+        self.assertIn('kintone_errors_total{code="GAIA_CO02"} 1', text)
+        self.assertIn('kintone_errors_total{code="HTTP 502"} 1', text)
+        self.assertIn('kintone_errors_total{code="ConnectionError"} 1', text)
+
+
+class MetricsServerTest(unittest.TestCase):
+    def setUp(self):
+        self._metrics = metrics.OroshiMetrics()
+        self._server = metrics.MetricsServer(self._metrics.registry, 0)
+        self._server.start()
+
+    def tearDown(self):
+        self._server.stop()
+
+    def url(self, path):
+        return 'http://127.0.0.1:{}{}'.format(self._server.port, path)
+
+    def test_get_metrics(self):
+        self._metrics.scanned()
+        with urllib.request.urlopen(self.url('/metrics')) as resp:
+            self.assertEqual(resp.status, 200)
+            self.assertTrue(
+                resp.headers['Content-Type'].startswith('text/plain'))
+            text = resp.read().decode('utf-8')
+        self.assertIn('oroshi_scans_total 1', text)
+
+    def test_not_found(self):
+        with self.assertRaises(urllib.error.HTTPError) as cm:
+            urllib.request.urlopen(self.url('/'))
+        self.assertEqual(cm.exception.code, 404)
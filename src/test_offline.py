@@ -0,0 +1,167 @@
+import csv
+import io
+import os
+import tempfile
+import unittest
+
+import offline
+import oroshi
+from fakes import (
+    ISBN1, ISBN2, ISBN3, IN_SHELF, LOST,
+    FAKE_RECORD1, FAKE_RECORD2, FAKE_RECORD22, FAKE_RECORD31)
+
+
+CSV_HEADER = ['レコード番号', 'title', 'isbn10', 'isbn13', 'exists',
+              'inventoried', 'type', 'ステータス', 'note']
+
+
+# Subclasses set self._instance to a bookstore which has FAKE_RECORD1,
+# FAKE_RECORD2, FAKE_RECORD22 and FAKE_RECORD31.
+class OfflineBookstoreTestMixin:
+    def reopen(self):
+        return self._instance
+
+    def test_find_records_by_isbn(self):
+        records = list(self._instance.find_records_by_isbn(ISBN1))
+        self.assertEqual(
+            sorted(records), [FAKE_RECORD1, FAKE_RECORD2, FAKE_RECORD22])
+
+        records = list(self._instance.find_records_by_isbn(ISBN3))
+        self.assertEqual(records, [FAKE_RECORD31])
+
+        records = list(self._instance.find_records_by_isbn(ISBN2))
+        self.assertEqual(records, [])
+
+    def test_find_records_by_isbns(self):
+        records = list(self._instance.find_records_by_isbns([ISBN1, ISBN3]))
+        self.assertEqual(
+            sorted(records),
+            [FAKE_RECORD1, FAKE_RECORD2, FAKE_RECORD22, FAKE_RECORD31])
+
+    def test_get_record(self):
+        self.assertEqual(self._instance.get_record(22), FAKE_RECORD22)
+        self.assertIsNone(self._instance.get_record(100))
+
+    def test_find_inventoried_records(self):
+        self.assertEqual(
+            list(self._instance.find_inventoried_records()), [FAKE_RECORD1])
+        self.assertEqual(
+            list(self._instance.find_inventoried_records(1)), [])
+
+    def test_add_record(self):
+        record = oroshi.BookRecord(
+            None, IN_SHELF, 'NO_TITLE', None, ISBN2, 'o', True, '未分類')
+        self._instance.add_record(record)
+
+        records = list(self.reopen().find_records_by_isbn(ISBN2))
+        self.assertEqual(len(records), 1)
+        self.assertEqual(records[0].title, 'NO_TITLE')
+        self.assertTrue(records[0].inventoried)
+
+    def test_update_record(self):
+        self._instance.update_record(
+            FAKE_RECORD22._replace(inventoried=True, status=IN_SHELF))
+
+        record = self.reopen().get_record(22)
+        self.assertTrue(record.inventoried)
+        # update_record はステータスを変えない
+        self.assertEqual(record.status, LOST)
+
+    def test_update_record_not_found(self):
+        with self.assertRaises(RuntimeError):
+            self._instance.update_record(FAKE_RECORD2._replace(record_id=100))
+
+    def test_clear_inventoried(self):
+        self._instance.clear_inventoried([1])
+        record = self.reopen().get_record(1)
+        self.assertFalse(record.inventoried)
+        self.assertEqual(record.title, 'book1')
+
+    def test_found(self):
+        self._instance.found(22)
+        self.assertEqual(self.reopen().get_record(22).status, IN_SHELF)
+
+    def test_run_once(self):
+        stdin = io.StringIO('{}\n{}\n{}\n\ndo\n'.format(ISBN1, ISBN1, ISBN2))
+        o = oroshi.Oroshi(self._instance, stdin=stdin, stdout=io.StringIO())
+        o.run_once()
+
+        bookstore = self.reopen()
+        self.assertTrue(bookstore.get_record(2).inventoried)
+        record = bookstore.get_record(22)
+        self.assertTrue(record.inventoried)
+        self.assertEqual(record.status, IN_SHELF)
+        self.assertEqual(len(list(bookstore.find_records_by_isbn(ISBN2))), 1)
+
+
+class SqliteBookstoreTest(OfflineBookstoreTestMixin, unittest.TestCase):
+    def setUp(self):
+        self._dir = tempfile.TemporaryDirectory()
+        self._path = os.path.join(self._dir.name, 'hondana.sqlite3')
+        self._instance = offline.SqliteBookstore(self._path)
+        self._instance.import_records(
+            [FAKE_RECORD1, FAKE_RECORD2, FAKE_RECORD22, FAKE_RECORD31])
+        self._reopened = []
+
+    def tearDown(self):
+        self._instance.close()
+        for bookstore in self._reopened:
+            bookstore.close()
+        self._dir.cleanup()
+
+    def reopen(self):
+        bookstore = offline.SqliteBookstore(self._path)
+        self._reopened.append(bookstore)
+        return bookstore
+
+    def test_find_records_by_isbns_many(self):
+        isbns = ['978{:010}'.format(i) for i in range(1000)] + [ISBN3]
+        records = list(self._instance.find_records_by_isbns(isbns))
+        self.assertEqual(records, [FAKE_RECORD31])
+
+
+class CsvBookstoreTest(OfflineBookstoreTestMixin, unittest.TestCase):
+    def setUp(self):
+        self._dir = tempfile.TemporaryDirectory()
+        self._path = os.path.join(self._dir.name, 'hondana.csv')
+        with open(self._path, 'w', newline='', encoding='utf-8-sig') as f:
+            writer = csv.writer(f)
+            writer.writerow(CSV_HEADER)
+            writer.writerow(['1', 'book1', '', ISBN1, 'o', '済み', 'UI', '本棚にあります', 'a'])
+            writer.writerow(['2', 'book1', '', ISBN1, 'o', '', 'UI', '本棚にあります', 'b'])
+            writer.writerow(['22', 'book1', '', ISBN1, 'o', '', 'UI', '紛失中', 'c'])
+            writer.writerow(['31', 'book3', ISBN3, '', 'o', '', 'UI', '本棚にあります', 'd'])
+        self._instance = offline.CsvBookstore(self._path)
+
+    def tearDown(self):
+        self._dir.cleanup()
+
+    def reopen(self):
+        self._instance.close()
+        return offline.CsvBookstore(self._path)
+
+    def test_keep_unknown_columns(self):
+        self._instance.update_record(FAKE_RECORD2._replace(inventoried=True))
+        self._instance.close()
+
+        with open(self._path, newline='', encoding='utf-8-sig') as f:
+            rows = list(csv.DictReader(f))
+        self.assertEqual([r['note'] for r in rows], ['a', 'b', 'c', 'd'])
+        self.assertEqual(rows[1]['inventoried'], '済み')
+
+    def test_import_records(self):
+        self._instance.import_records([
+            FAKE_RECORD22._replace(status=IN_SHELF, inventoried=True),
+            oroshi.BookRecord(40, IN_SHELF, 'book2', '', ISBN2, 'o', True, 'UI')])
+
+        bookstore = self.reopen()
+        record = bookstore.get_record(22)
+        self.assertEqual(record.status, IN_SHELF)
+        self.assertTrue(record.inventoried)
+        self.assertEqual(bookstore.get_record(40).title, 'book2')
+
+    def test_missing_column(self):
+        with open(self._path, 'w', newline='', encoding='utf-8-sig') as f:
+            csv.writer(f).writerow(['レコード番号', 'title'])
+        with self.assertRaises(ValueError):
+            offline.CsvBookstore(self._path)
@@ -3,30 +3,12 @@ import unittest
 from unittest import mock
 
 import oroshi
-
-
-ISBN1 = '9784789849944'
-ISBN2 = '9784839919849'
-ISBN3 = '4810180778'
-
-IN_SHELF = oroshi.RecordStatus.IN_SHELF
-BORROWED = oroshi.RecordStatus.BORROWED
-LOST = oroshi.RecordStatus.LOST
-
-FAKE_RECORD1  = oroshi.BookRecord(1,  IN_SHELF, 'book1', '', ISBN1, 'o', True,  'UI')
-FAKE_RECORD2  = oroshi.BookRecord(2,  IN_SHELF, 'book1', '', ISBN1, 'o', False, 'UI')
-FAKE_RECORD3  = oroshi.BookRecord(3,  IN_SHELF, 'book1', '', ISBN1, 'x', True,  'UI')
-FAKE_RECORD4  = oroshi.BookRecord(4,  IN_SHELF, 'book1', '', ISBN1, 'x', False, 'UI')
-FAKE_RECORD11 = oroshi.BookRecord(11, BORROWED, 'book1', '', ISBN1, 'o', True,  'UI')
-FAKE_RECORD12 = oroshi.BookRecord(12, BORROWED, 'book1', '', ISBN1, 'o', False, 'UI')
-FAKE_RECORD13 = oroshi.BookRecord(13, BORROWED, 'book1', '', ISBN1, 'x', True,  'UI')
-FAKE_RECORD14 = oroshi.BookRecord(14, BORROWED, 'book1', '', ISBN1, 'x', False, 'UI')
-FAKE_RECORD21 = oroshi.BookRecord(21, LOST,     'book1', '', ISBN1, 'o', True,  'UI')
-FAKE_RECORD22 = oroshi.BookRecord(22, LOST,     'book1', '', ISBN1, 'o', False, 'UI')
-FAKE_RECORD23 = oroshi.BookRecord(23, LOST,     'book1', '', ISBN1, 'x', True,  'UI')
-FAKE_RECORD24 = oroshi.BookRecord(24, LOST,     'book1', '', ISBN1, 'x', False, 'UI')
-FAKE_RECORD30 = oroshi.BookRecord(30, IN_SHELF, 'book2', '', ISBN2, 'o', False, 'UI')
-FAKE_RECORD31 = oroshi.BookRecord(31, IN_SHELF, 'book3', ISBN3, '', 'o', False, 'UI')
+from fakes import (
+    ISBN1, ISBN2, ISBN3, IN_SHELF, LOST,
+    FAKE_RECORD1, FAKE_RECORD2, FAKE_RECORD3, FAKE_RECORD4,
+    FAKE_RECORD11, FAKE_RECORD12, FAKE_RECORD13, FAKE_RECORD14,
+    FAKE_RECORD21, FAKE_RECORD22, FAKE_RECORD23, FAKE_RECORD24,
+    FAKE_RECORD30, FAKE_RECORD31, FakeBookstore)
 
 
 class OroshiFuncTest(unittest.TestCase):
@@ -43,6 +25,22 @@ class OroshiFuncTest(unittest.TestCase):
         self.assertEqual(barcodes, [ISBN1])
         self.assertEqual(last, 'hogera')
 
+    def test_iter_barcodes(self):
+        inp = io.StringIO('{}\n{}\nhogera\n{}\n'.format(ISBN1, ISBN2, ISBN3))
+        it = oroshi.iter_barcodes(inp)
+        self.assertEqual(next(it), ISBN1)
+        self.assertEqual(next(it), ISBN2)
+        with self.assertRaises(StopIteration) as cm:
+            next(it)
+        self.assertEqual(cm.exception.value, 'hogera')
+        # 終端行の後ろは読まない
+        self.assertEqual(inp.readline(), ISBN3 + '\n')
+
+    def test_chunked(self):
+        self.assertEqual(
+            list(oroshi.chunked(range(5), 2)), [[0, 1], [2, 3], [4]])
+        self.assertEqual(list(oroshi.chunked([], 2)), [])
+
     def test_get_isbn(self):
         self.assertEqual(oroshi.get_isbn(FAKE_RECORD1), ISBN1)
         self.assertEqual(oroshi.get_isbn(FAKE_RECORD31), ISBN3)
@@ -166,6 +164,41 @@ class OroshiFuncTest(unittest.TestCase):
         self.assertIsInstance(action, oroshi.Found)
         self.assertEqual(action.record, FAKE_RECORD22)
 
+    def test_iter_actions(self):
+        bookstore = FakeBookstore(
+            [FAKE_RECORD2, FAKE_RECORD22, FAKE_RECORD30, FAKE_RECORD31])
+        barcodes = [ISBN1, ISBN2, ISBN1, ISBN3, ISBN1, ISBN2]
+        actions = list(oroshi.iter_actions(barcodes, bookstore, chunk_size=2))
+
+        self.assertEqual(
+            [a.name for a in actions],
+            ['TakeInventory', 'TakeInventory', 'Found',
+             'TakeInventory', 'RegisterNew', 'RegisterNew'])
+        # 同じ ISBN は一度だけ検索する
+        self.assertEqual(bookstore.lookups, [[ISBN1, ISBN2], [ISBN3]])
+
+    def test_iter_actions_decide_actions_と同じ結果(self):
+        records = [FAKE_RECORD2, FAKE_RECORD4, FAKE_RECORD12, FAKE_RECORD22,
+                   FAKE_RECORD30]
+        barcodes = [ISBN1, ISBN1, ISBN2, ISBN1, ISBN1, ISBN1, ISBN2]
+        expected = oroshi.decide_actions(barcodes, records, None)
+        actions = oroshi.iter_actions(
+            barcodes, FakeBookstore(records), chunk_size=3)
+
+        self.assertEqual(
+            [(a.name, a.record) for a in actions],
+            [(a.name, a.record) for a in expected])
+
+    def test_iter_actions_lazy(self):
+        bookstore = FakeBookstore([FAKE_RECORD2])
+        inp = io.StringIO('{}\n{}\n'.format(ISBN1, ISBN2))
+        actions = oroshi.iter_actions(
+            oroshi.iter_barcodes(inp), bookstore, chunk_size=1)
+
+        action = next(actions)
+        self.assertIsInstance(action, oroshi.TakeInventory)
+        self.assertEqual(bookstore.lookups, [[ISBN1]])
+
     def test_show_action_selections(self):
         stdout = io.StringIO()
         actions = oroshi.decide_actions([ISBN1], [FAKE_RECORD2], None)
@@ -206,6 +239,19 @@ class OroshiFuncTest(unittest.TestCase):
         self.assertNotIn(FAKE_RECORD2.title, line)
         self.assertIn(oroshi.RegisterNew(None, None).name, line)
 
+    def test_show_action_selections_register_new_with_metadata(self):
+        stdout = io.StringIO()
+        bibindex = {ISBN1: oroshi.BookMetadata('indexed title', None)}
+        actions = oroshi.decide_actions([ISBN1], [], None, bibindex=bibindex)
+        oroshi.show_action_selections(
+            (oroshi.ActionSelection(True, a) for a in actions), file=stdout)
+
+        stdout.seek(0)
+        _ = stdout.readline()
+        line = stdout.readline()
+        self.assertIn('indexed title', line)
+        self.assertIn('no-type', line)
+
     def test_select_actions(self):
         stdin = io.StringIO('1\ndo\n')
         stdout = io.StringIO()
@@ -255,43 +301,6 @@ class FakePrinter:
         self.called = True
 
 
-class FakeBookstore(oroshi.Bookstore):
-    def __init__(self, records):
-        # record_id must be unique to each other.
-        self._records = records
-
-    def find_records_by_isbn(self, isbn: str):
-        if len(isbn) == 10:
-            return (r for r in self._records if r.isbn10 == isbn)
-        if len(isbn) == 13:
-            return (r for r in self._records if r.isbn13 == isbn)
-
-    def get_record(self, record_id: int):
-        for r in self._records:
-            if r.record_id == record_id:
-                return r
-
-    def add_record(self, record: oroshi.BookRecord):
-        self._records.append(record)
-
-    def update_record(self, record: oroshi.BookRecord):
-        r = self.get_record(record.record_id)
-        if r is None:
-            raise RuntimeError('not found any records with ID', record.record_id)
-        self._records.remove(r)
-        # preserve original status
-        record = record._replace(status=r.status)
-        self._records.append(record)
-
-    def found(self, record_id: int):
-        r = self.get_record(record_id)
-        if r is None:
-            raise RuntimeError('not found any records with ID', record.record_id)
-        self._records.remove(r)
-        record = r._replace(status=IN_SHELF)
-        self._records.append(record)
-
-
 class TakeInventoryTest(unittest.TestCase):
     def setUp(self):
         records = [FAKE_RECORD2]
@@ -320,6 +329,26 @@ class RegisterNewTest(unittest.TestCase):
         self.assertEqual(oroshi.get_isbn(records[0]), ISBN3)
 
 
+class RegisterNewWithMetadataTest(unittest.TestCase):
+    def test_act(self):
+        bookstore = FakeBookstore([])
+        metadata = oroshi.BookMetadata('book3', 'UI')
+        oroshi.RegisterNew(ISBN3, bookstore, metadata).act()
+
+        record, = bookstore.find_records_by_isbn(ISBN3)
+        self.assertEqual(record.title, 'book3')
+        self.assertEqual(record.type, 'UI')
+
+    def test_act_without_category(self):
+        bookstore = FakeBookstore([])
+        metadata = oroshi.BookMetadata('book3', None)
+        oroshi.RegisterNew(ISBN3, bookstore, metadata).act()
+
+        record, = bookstore.find_records_by_isbn(ISBN3)
+        self.assertEqual(record.title, 'book3')
+        self.assertEqual(record.type, oroshi.RegisterNew.NO_TYPE)
+
+
 class DiscardTest(unittest.TestCase):
     def setUp(self):
         self._instance = oroshi.Discard(FAKE_RECORD4)
@@ -438,3 +467,39 @@ class OroshiTest(unittest.TestCase):
         self._instance.run_once()
         r = self._bookstore.get_record(2)
         self.assertTrue(r.inventoried)
+
+    def test_metrics(self):
+        m = RecordingMetrics()
+        instance = oroshi.Oroshi(
+            self._bookstore, stdin=self._stdin, stdout=self._stdout,
+            metrics=m)
+        self._stdin.write('{}\n{}\n\ndo\n'.format(ISBN1, ISBN2))
+        self._stdin.seek(0)
+        instance.run_once()
+        self.assertEqual(m.events, [
+            'pending ', 'scanned', 'scanned', 'lookup',
+            'decided TakeInventory', 'decided RegisterNew',
+            'pending TakeInventory RegisterNew',
+            'applying TakeInventory', 'applying RegisterNew'])
+
+
+class RecordingMetrics(oroshi.NullMetrics):
+    def __init__(self):
+        self.events = []
+
+    def scanned(self):
+        self.events.append('scanned')
+
+    def lookup(self):
+        self.events.append('lookup')
+        return super().lookup()
+
+    def decided(self, action_name):
+        self.events.append('decided ' + action_name)
+
+    def set_pending(self, action_names):
+        self.events.append('pending ' + ' '.join(action_names))
+
+    def applying(self, action_name):
+        self.events.append('applying ' + action_name)
+        return super().applying(action_name)
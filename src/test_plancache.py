@@ -0,0 +1,113 @@
+import io
+import os
+import tempfile
+import unittest
+
+import oroshi
+import plancache
+from fakes import (
+    ISBN1, ISBN2, ISBN4, FAKE_RECORD30, KINTONE_RECORDS, FakeBookstore)
+
+
+class PlanCacheTest(unittest.TestCase):
+    def setUp(self):
+        self._dir = tempfile.TemporaryDirectory()
+        self._path = os.path.join(self._dir.name, 'plan.json')
+        self._bookstore = FakeBookstore(KINTONE_RECORDS)
+
+    def tearDown(self):
+        self._dir.cleanup()
+
+    def run_session(self, isbns, command='quit', *, cache=None):
+        # Returns the output of one run_once, like a new process would.
+        cache = plancache.PlanCache(self._path) if cache is None else cache
+        stdin = io.StringIO('\n'.join(isbns) + '\n\n{}\n'.format(command))
+        stdout = io.StringIO()
+        o = oroshi.Oroshi(self._bookstore, stdin=stdin, stdout=stdout,
+                          plan_cache=cache)
+        try:
+            o.run_once()
+        except SystemExit:
+            pass
+        return stdout.getvalue()
+
+    def test_look_up_new_isbns_only(self):
+        self.run_session([ISBN1])
+        self.assertEqual(self._bookstore.lookups, [[ISBN1]])
+
+        self.run_session([ISBN1, ISBN2, ISBN1])
+        self.assertEqual(self._bookstore.lookups, [[ISBN1], [ISBN2]])
+
+        self.run_session([ISBN2, ISBN1])
+        self.assertEqual(self._bookstore.lookups, [[ISBN1], [ISBN2]])
+
+    def test_look_up_isbns_without_records(self):
+        self.run_session([ISBN4])
+        # someone else registered the book
+        self._bookstore.add_record(FAKE_RECORD30._replace(
+            record_id=None, title='book4', isbn13=ISBN4))
+
+        output = self.run_session([ISBN4], command='do')
+        self.assertEqual(self._bookstore.lookups, [[ISBN4], [ISBN4]])
+        self.assertIn('+ TakeInventory  {}'.format(ISBN4), output)
+        # 重複して登録しない
+        record, = self._bookstore.find_records_by_isbn(ISBN4)
+        self.assertTrue(record.inventoried)
+
+    def test_look_up_edited_records(self):
+        self.run_session([ISBN1, ISBN2])
+        # someone else took inventory of record 2
+        self._bookstore.edit(2, inventoried=True)
+
+        output = self.run_session([ISBN1, ISBN2])
+        self.assertEqual(self._bookstore.lookups, [[ISBN1, ISBN2], [ISBN1]])
+        self.assertIn('1 removed, 1 added', output)
+        self.assertIn('- TakeInventory  {}'.format(ISBN1), output)
+        self.assertIn('+ Found          {}'.format(ISBN1), output)
+
+    def test_plan_diff(self):
+        output = self.run_session([ISBN1])
+        self.assertNotIn('previous session', output)
+
+        output = self.run_session([ISBN1, ISBN4, ISBN1])
+        self.assertIn('0 removed, 2 added', output)
+        self.assertIn('+ RegisterNew  {}'.format(ISBN4), output)
+        self.assertIn('+ Found        {}  book1 (UI)'.format(ISBN1), output)
+
+        output = self.run_session([ISBN4, ISBN1, ISBN1])
+        self.assertIn('Same plan as the previous session', output)
+
+    def test_forget_written_isbns(self):
+        self.run_session([ISBN1, ISBN4, ISBN2], command='2\ndo')
+        # ISBN4 had no records, so it is looked up again as well as ISBN1,
+        # which was written to. The action for ISBN2 was not selected.
+        output = self.run_session([ISBN1, ISBN4, ISBN2])
+        self.assertEqual(self._bookstore.lookups,
+                         [[ISBN1, ISBN4, ISBN2], [ISBN1, ISBN4]])
+        self.assertNotIn('previous session', output)
+
+    def test_expire(self):
+        now = [1000.0]
+        cache = plancache.PlanCache(self._path, clock=lambda: now[0])
+        self.run_session([ISBN1], cache=cache)
+
+        now[0] += plancache.MAX_AGE + 1
+        cache = plancache.PlanCache(self._path, clock=lambda: now[0])
+        self.run_session([ISBN1], cache=cache)
+        self.assertEqual(self._bookstore.lookups, [[ISBN1], [ISBN1]])
+
+    def test_records_without_revision(self):
+        cache = plancache.PlanCache(self._path)
+        record2 = KINTONE_RECORDS[0]
+        record = FAKE_RECORD30._replace(record_id=None)
+        cache.put([ISBN1, ISBN2, ISBN4], [record2, record])
+        self.assertEqual(cache.get(ISBN1), [record2])
+        self.assertIsNone(cache.get(ISBN2))
+        self.assertIsNone(cache.get(ISBN4))
+
+    def test_diff_plans(self):
+        a = plancache.PlanEntry('TakeInventory', ISBN1, 2, 'book1', 'UI')
+        b = plancache.PlanEntry('RegisterNew', ISBN4, None, 'NO_TITLE', '')
+        removed, added = plancache.diff_plans([a, b, a], [b, a, b])
+        self.assertEqual(removed, [a])
+        self.assertEqual(added, [b])
@@ -0,0 +1,148 @@
+import os
+import tempfile
+import threading
+import unittest
+
+import reset
+from fakes import FakeBookstore, make_record
+
+
+# FailingBookstore counts the batches and fails the given one. The workers of
+# the resetter write to it at the same time, hence the lock.
+class FailingBookstore(FakeBookstore):
+    def __init__(self, records, fail_on_batch=None):
+        super().__init__(records)
+        self._lock = threading.RLock()
+        self._fail_on_batch = fail_on_batch
+        self.num_batches = 0
+
+    def edit(self, record_id: int, **kwargs):
+        with self._lock:
+            super().edit(record_id, **kwargs)
+
+    def clear_inventoried(self, record_ids):
+        with self._lock:
+            if self.num_batches == self._fail_on_batch:
+                raise RuntimeError('fake failure')
+            self.num_batches += 1
+            super().clear_inventoried(record_ids)
+
+
+# EditingBookstore edits each record right after it was read, as somebody
+# working in kintone during the reset would.
+class EditingBookstore(FailingBookstore):
+    def find_inventoried_records(self, after_id: int = 0):
+        for record in super().find_inventoried_records(after_id):
+            yield record
+            self.edit(record.record_id, title='edited')
+
+
+class CheckpointTest(unittest.TestCase):
+    def setUp(self):
+        self._dir = tempfile.TemporaryDirectory()
+        self._instance = reset.Checkpoint(
+            os.path.join(self._dir.name, 'reset.checkpoint'))
+
+    def tearDown(self):
+        self._dir.cleanup()
+
+    def test_load_without_file(self):
+        self.assertEqual(self._instance.load(), 0)
+
+    def test_save_and_load(self):
+        self._instance.save(42, 1700000000.5)
+        self.assertEqual(self._instance.load(), 42)
+        self.assertEqual(self._instance.started_at(), 1700000000.5)
+        self._instance.clear()
+        self.assertEqual(self._instance.load(), 0)
+        self.assertIsNone(self._instance.started_at())
+
+    def test_load_without_start_time(self):
+        self._instance.save(42)
+        self.assertEqual(self._instance.load(), 42)
+        self.assertIsNone(self._instance.started_at())
+
+
+class InventoryResetterTest(unittest.TestCase):
+    def setUp(self):
+        self._dir = tempfile.TemporaryDirectory()
+        self._checkpoint = reset.Checkpoint(
+            os.path.join(self._dir.name, 'reset.checkpoint'))
+        self._messages = []
+
+    def tearDown(self):
+        self._dir.cleanup()
+
+    def make_resetter(self, bookstore, **kwargs):
+        return reset.InventoryResetter(
+            bookstore, batch_size=3, workers=2, checkpoint=self._checkpoint,
+            progress=self._messages.append, **kwargs)
+
+    def test_run(self):
+        records = [make_record(i, i % 4 != 0) for i in range(1, 21)]
+        bookstore = FailingBookstore(records)
+
+        num_reset = self.make_resetter(bookstore).run()
+
+        self.assertEqual(num_reset, 15)
+        self.assertEqual(bookstore.num_batches, 5)
+        for i in range(1, 21):
+            self.assertFalse(bookstore.get_record(i).inventoried)
+        # 完了したらチェックポイントは消える
+        self.assertEqual(self._checkpoint.load(), 0)
+        self.assertTrue(self._messages)
+
+    def test_run_resume(self):
+        records = [make_record(i, True) for i in range(1, 11)]
+        bookstore = FailingBookstore(records, fail_on_batch=2)
+
+        with self.assertRaises(RuntimeError):
+            self.make_resetter(bookstore).run()
+
+        # 失敗したバッチより前までは記録されている
+        self.assertEqual(self._checkpoint.load(), 6)
+        self.assertFalse(bookstore.get_record(6).inventoried)
+        self.assertTrue(bookstore.get_record(7).inventoried)
+
+        bookstore._fail_on_batch = None
+        num_reset = self.make_resetter(bookstore, resume=True).run()
+        self.assertEqual(num_reset, 4)
+        for i in range(1, 11):
+            self.assertFalse(bookstore.get_record(i).inventoried)
+
+    def test_run_without_resume(self):
+        records = [make_record(i, True) for i in range(1, 11)]
+        bookstore = FailingBookstore(records, fail_on_batch=2)
+        with self.assertRaises(RuntimeError):
+            self.make_resetter(bookstore).run()
+        started_at = self._checkpoint.started_at()
+        self.assertIsNotNone(started_at)
+
+        # 中断したリセットの続きからは、指定しない限り始めない
+        bookstore._fail_on_batch = None
+        with self.assertRaises(reset.InterruptedReset) as cm:
+            self.make_resetter(bookstore).run()
+        self.assertIn('after record 6', str(cm.exception))
+        self.assertTrue(bookstore.get_record(7).inventoried)
+
+        # 再開しても、チェックポイントには最初に始めた時刻が残る
+        bookstore._fail_on_batch = 3
+        with self.assertRaises(RuntimeError):
+            self.make_resetter(bookstore, resume=True).run()
+        self.assertEqual(self._checkpoint.load(), 9)
+        self.assertEqual(self._checkpoint.started_at(), started_at)
+
+    def test_run_keeps_edits(self):
+        records = [make_record(i, True) for i in range(1, 5)]
+        bookstore = EditingBookstore(records)
+
+        self.make_resetter(bookstore).run()
+
+        for i in range(1, 5):
+            record = bookstore.get_record(i)
+            self.assertFalse(record.inventoried)
+            self.assertEqual(record.title, 'edited')
+
+    def test_invalid_batch_size(self):
+        with self.assertRaises(ValueError):
+            reset.InventoryResetter(FailingBookstore([]), batch_size=0)
@@ -0,0 +1,357 @@
+import csv
+import io
+import os
+import tempfile
+import time
+import unittest
+
+import offline
+import oroshi
+import writebehind
+from fakes import (
+    ISBN1, ISBN2, ISBN4, IN_SHELF, LOST, KINTONE_RECORDS, FakeBookstore)
+
+
+class WriteBehindTestBase(unittest.TestCase):
+    def setUp(self):
+        self._dir = tempfile.TemporaryDirectory()
+        self._path = os.path.join(self._dir.name, 'queue.sqlite3')
+        self._queue = writebehind.WriteQueue(self._path)
+        self._remote = FakeBookstore(KINTONE_RECORDS)
+        self._instance = writebehind.WriteBehindBookstore(
+            self._remote, self._queue)
+        self._flusher = writebehind.Flusher(
+            self._queue, self._remote, progress=lambda msg: None)
+
+    def tearDown(self):
+        self._queue.close()
+        self._dir.cleanup()
+
+    def scan(self, *barcodes):
+        stdin = io.StringIO(''.join(b + '\n' for b in barcodes) + '\ndo\n')
+        o = oroshi.Oroshi(self._instance, stdin=stdin, stdout=io.StringIO())
+        o.run_once()
+
+
+class WriteBehindBookstoreTest(WriteBehindTestBase):
+    def test_writes_are_queued(self):
+        self.scan(ISBN1, ISBN1, ISBN2, ISBN2)
+
+        # まだ kintone には書き込まれない
+        self.assertFalse(self._remote.get_record(2).inventoried)
+        self.assertEqual(self._remote.get_record(22).status, LOST)
+        self.assertEqual(self._remote.added, [])
+        self.assertEqual(
+            [w.kind for w in self._queue.pending()],
+            ['update', 'found', 'update', 'update', 'add'])
+
+    def test_reads_see_queued_writes(self):
+        self.scan(ISBN1)
+
+        record = self._instance.get_record(2)
+        self.assertTrue(record.inventoried)
+
+        # 別のセッションでも同じ本を二重に棚卸しない
+        bookstore = writebehind.WriteBehindBookstore(self._remote, self._queue)
+        records = list(bookstore.find_records_by_isbn(ISBN1))
+        self.assertEqual(
+            [r.inventoried for r in sorted(records)], [True, False])
+
+    def test_queued_update_carries_revision(self):
+        self.scan(ISBN2)
+        write, = self._queue.pending()
+        self.assertEqual(
+            write.record.revision, self._remote.get_record(30).revision)
+
+    def test_queue_is_durable(self):
+        self.scan(ISBN2)
+        self._queue.close()
+
+        self._queue = writebehind.WriteQueue(self._path)
+        write, = self._queue.pending()
+        record = self._remote.get_record(30)
+        self.assertEqual(write.record, record._replace(inventoried=True))
+
+
+class FlusherTest(WriteBehindTestBase):
+    def test_flush(self):
+        self.scan(ISBN1, ISBN1, ISBN2, ISBN2)
+        result = self._flusher.flush()
+
+        self.assertEqual(result, writebehind.FlushResult(5, 0))
+        self.assertEqual(self._queue.num_pending(), 0)
+        self.assertTrue(self._remote.get_record(2).inventoried)
+        record = self._remote.get_record(22)
+        self.assertTrue(record.inventoried)
+        self.assertEqual(record.status, IN_SHELF)
+        self.assertEqual(len(self._remote.added), 1)
+        # 追加、ステータス変更、更新をそれぞれ一括で送る
+        self.assertEqual(self._remote.num_requests, 5)
+
+    def test_flush_conflict(self):
+        self.scan(ISBN1, ISBN1, ISBN2)
+        # 棚卸中に誰かが kintone 上でレコードを編集した
+        self._remote.edit(22, title='edited')
+        self._remote.edit(30, title='edited')
+
+        result = self._flusher.flush()
+
+        self.assertEqual(result, writebehind.FlushResult(1, 3))
+        self.assertTrue(self._remote.get_record(2).inventoried)
+        # 上書きせずに確認待ちにする
+        record = self._remote.get_record(22)
+        self.assertEqual(record.status, LOST)
+        self.assertFalse(record.inventoried)
+        self.assertEqual(record.title, 'edited')
+        self.assertFalse(self._remote.get_record(30).inventoried)
+
+        conflicts = self._queue.conflicts()
+        self.assertEqual(
+            sorted((w.kind, w.record.record_id) for w, _ in conflicts),
+            [('found', 22), ('update', 22), ('update', 30)])
+
+    def test_mark_reviewed(self):
+        self.scan(ISBN2)
+        self._remote.edit(30, title='edited')
+        self._flusher.flush()
+
+        conflicts = self._queue.conflicts()
+        self.assertEqual(
+            self._queue.mark_reviewed(w for w, _ in conflicts), 1)
+        # 確認済みの conflict は次からは表示しない
+        self.assertEqual(self._queue.conflicts(), [])
+        self.assertEqual(
+            self._queue.mark_reviewed(w for w, _ in conflicts), 0)
+
+    def test_flush_conflict_while_applying(self):
+        self.scan(ISBN2)
+        update_records = self._remote.update_records
+
+        def edit_then_update(records):
+            # チェックした後、書き込むまでの間に編集された
+            self._remote.update_records = update_records
+            self._remote.edit(30, title='edited')
+            update_records(records)
+
+        self._remote.update_records = edit_then_update
+        result = self._flusher.flush()
+
+        self.assertEqual(result, writebehind.FlushResult(0, 1))
+        self.assertFalse(self._remote.get_record(30).inventoried)
+
+    def test_flush_network_error(self):
+        self.scan(ISBN2)
+
+        def fail(record_ids):
+            raise ConnectionError('network is unreachable')
+
+        self._remote.get_revisions = fail
+        self.assertIsNone(self._flusher.flush_quietly())
+        self.assertEqual(self._queue.num_pending(), 1)
+        self.assertEqual(self._flusher.num_errors, 1)
+
+    def test_flush_api_error(self):
+        self.scan(ISBN2)
+        get_revisions = self._remote.get_revisions
+
+        def fail_once(record_ids):
+            # kintone の API 制限などで一度だけ失敗する
+            self._remote.get_revisions = get_revisions
+            raise RuntimeError('failed to select revisions', 'CB_TH01')
+
+        self._remote.get_revisions = fail_once
+        self.assertIsNone(self._flusher.flush_quietly())
+        self.assertEqual(self._queue.num_pending(), 1)
+
+        self.assertEqual(
+            self._flusher.flush_quietly(), writebehind.FlushResult(1, 0))
+        self.assertTrue(self._remote.get_record(30).inventoried)
+        self.assertEqual(self._flusher.num_errors, 1)
+
+    def test_flush_resumes_after_found(self):
+        self.scan(ISBN1, ISBN1)
+        update_records = self._remote.update_records
+
+        def fail_once(records):
+            self._remote.update_records = update_records
+            raise RuntimeError('failed to update records')
+
+        # ステータス変更の後、更新で失敗した
+        self._remote.update_records = fail_once
+        self.assertIsNone(self._flusher.flush_quietly())
+
+        # 次の試行では、ステータス変更後のリビジョンと比べる
+        self.assertEqual(
+            self._flusher.flush_quietly(), writebehind.FlushResult(2, 0))
+        record = self._remote.get_record(22)
+        self.assertTrue(record.inventoried)
+        self.assertEqual(record.status, IN_SHELF)
+
+    def test_flush_keeps_conflicting(self):
+        self.scan(ISBN2)
+
+        def conflict(records):
+            raise oroshi.RevisionConflict('failed to update records')
+
+        # 書き込むたびに競合し続ける
+        self._remote.update_records = conflict
+        result = self._flusher.flush_quietly()
+
+        self.assertEqual(result, writebehind.FlushResult(0, 1))
+        self.assertEqual(self._flusher.num_errors, 0)
+        (_, message), = self._queue.conflicts()
+        self.assertIn('changing', message)
+
+    def test_flush_rejected(self):
+        self.scan(ISBN1, ISBN1, ISBN2)
+        update_records = self._remote.update_records
+
+        def reject_record2(records):
+            if any(r.record_id == 2 for r in records):
+                raise oroshi.RecordsRejected('failed to update records')
+            update_records(records)
+
+        # レコード 2 だけ kintone が受け付けない（入力値のエラーなど）
+        self._remote.update_records = reject_record2
+        self.assertEqual(self._flusher.flush(), writebehind.FlushResult(3, 0))
+        self.assertTrue(self._remote.get_record(30).inventoried)
+        self.assertEqual(
+            [w.record.record_id for w in self._queue.pending()], [2])
+
+        # 何度送っても受け付けられなければ、確認待ちにして次に進む
+        self.assertEqual(self._flusher.flush(), writebehind.FlushResult(0, 0))
+        self.assertEqual(self._flusher.flush(), writebehind.FlushResult(0, 1))
+        self.assertEqual(self._queue.num_pending(), 0)
+        (write, message), = self._queue.conflicts()
+        self.assertEqual(write.record.record_id, 2)
+        self.assertIn('rejected 3 times', message)
+
+    def test_flush_rejected_add(self):
+        self.scan(ISBN4)
+
+        def reject(records):
+            raise oroshi.RecordsRejected('failed to add records')
+
+        self._remote.add_records = reject
+        for _ in range(writebehind.Flusher.MAX_REJECTIONS):
+            self._flusher.flush()
+        self.assertEqual(self._queue.num_pending(), 0)
+        self.assertEqual(len(self._queue.conflicts()), 1)
+
+    def test_flush_until_empty_gives_up(self):
+        self.scan(ISBN2)
+
+        def fail(record_ids):
+            raise RuntimeError('failed to select revisions', 'GAIA_IA02')
+
+        self._remote.get_revisions = fail
+        self.assertFalse(writebehind.flush_until_empty(
+            self._flusher, self._queue, 0, max_failures=3))
+        self.assertEqual(self._flusher.num_errors, 3)
+        self.assertEqual(self._queue.num_pending(), 1)
+
+    def test_background_flusher_survives_errors(self):
+        self.scan(ISBN2)
+        get_revisions = self._remote.get_revisions
+
+        def fail_once(record_ids):
+            self._remote.get_revisions = get_revisions
+            raise RuntimeError('failed to select revisions')
+
+        self._remote.get_revisions = fail_once
+        background_flusher = writebehind.BackgroundFlusher(
+            self._flusher, 0.01)
+        background_flusher.start()
+        try:
+            for _ in range(500):
+                if self._queue.num_pending() == 0:
+                    break
+                time.sleep(0.01)
+        finally:
+            background_flusher.stop()
+
+        self.assertEqual(self._queue.num_pending(), 0)
+        self.assertEqual(background_flusher.num_errors, 1)
+
+
+class OfflineFlushTest(WriteBehindTestBase):
+    def setUp(self):
+        super().setUp()
+        self._local = offline.SqliteBookstore(
+            os.path.join(self._dir.name, 'hondana.sqlite3'))
+        self._local.import_records(KINTONE_RECORDS)
+        self._instance = writebehind.WriteBehindBookstore(
+            self._local, self._queue)
+        self._flusher = writebehind.Flusher(
+            self._queue, self._remote, local=self._local,
+            progress=lambda msg: None)
+
+    def tearDown(self):
+        self._local.close()
+        super().tearDown()
+
+    def test_flush_updates_local(self):
+        self.scan(ISBN1, ISBN4)
+        self.assertEqual(self._flusher.flush(), writebehind.FlushResult(2, 0))
+
+        # 送った後のセッションでも、棚卸済みで新しいリビジョンのレコードが見える
+        self._instance = writebehind.WriteBehindBookstore(
+            self._local, self._queue)
+        record = self._instance.get_record(2)
+        self.assertTrue(record.inventoried)
+        self.assertEqual(record.revision, self._remote.get_record(2).revision)
+        added, = self._instance.find_records_by_isbn(ISBN4)
+        self.assertIsNotNone(added.record_id)
+
+        # レコード 2 は再び提案されず、レコード 22 の更新も競合しない
+        self.scan(ISBN1)
+        self.assertEqual(
+            [w.kind for w in self._queue.pending()], ['found', 'update'])
+        self.assertEqual(self._flusher.flush(), writebehind.FlushResult(2, 0))
+
+
+class CsvFlushTest(WriteBehindTestBase):
+    def open_csv(self, with_revisions: bool):
+        path = os.path.join(self._dir.name, 'hondana.csv')
+        header = ['レコード番号', 'title', 'isbn10', 'isbn13', 'exists',
+                  'inventoried', 'type', 'ステータス']
+        with open(path, 'w', newline='', encoding='utf-8-sig') as f:
+            writer = csv.writer(f)
+            writer.writerow(header + ['$revision'] * with_revisions)
+            for r in KINTONE_RECORDS:
+                row = [str(r.record_id), r.title, r.isbn10, r.isbn13,
+                       r.exists, '', r.type, offline.STATUS_NAMES[r.status]]
+                writer.writerow(row + [str(r.revision)] * with_revisions)
+        self._local = offline.CsvBookstore(path)
+        self._instance = writebehind.WriteBehindBookstore(
+            self._local, self._queue)
+        self._flusher = writebehind.Flusher(
+            self._queue, self._remote, local=self._local,
+            progress=lambda msg: None)
+
+    def test_flush_checks_revision(self):
+        self.open_csv(with_revisions=True)
+        self.scan(ISBN2)
+        self._remote.edit(30, title='edited')
+
+        self.assertEqual(self._flusher.flush(), writebehind.FlushResult(0, 1))
+        self.assertEqual(self._remote.get_record(30).title, 'edited')
+
+    def test_flush_updates_revision(self):
+        self.open_csv(with_revisions=True)
+        self.scan(ISBN2)
+
+        self.assertEqual(self._flusher.flush(), writebehind.FlushResult(1, 0))
+        self.assertEqual(self._local.get_record(30).revision,
+                         self._remote.get_record(30).revision)
+
+    def test_flush_without_revisions(self):
+        self.open_csv(with_revisions=False)
+        self.scan(ISBN2)
+        self._remote.edit(30, title='edited')
+
+        # リビジョンが無いと編集されたか分からないので、上書きせずに確認待ちにする
+        self.assertEqual(self._flusher.flush(), writebehind.FlushResult(0, 1))
+        self.assertEqual(self._remote.get_record(30).title, 'edited')
+        (_, message), = self._queue.conflicts()
+        self.assertIn('no revision', message)
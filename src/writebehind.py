@@ -0,0 +1,462 @@
+import collections
+import json
+import sqlite3
+import threading
+import time
+from typing import Iterable, List
+
+import oroshi
+
+
+QueuedWrite = collections.namedtuple(
+    'QueuedWrite', ['write_id', 'kind', 'record'])
+
+ADD = 'add'
+FOUND = 'found'
+UPDATE = 'update'
+
+PENDING = 'pending'
+DONE = 'done'
+CONFLICT = 'conflict'
+# a conflict which the operator has looked at
+REVIEWED = 'reviewed'
+
+
+def record_to_dict(record: oroshi.BookRecord) -> dict:
+    fields = record._asdict()
+    fields['status'] = record.status.name
+    return fields
+
+
+def record_from_dict(fields: dict) -> oroshi.BookRecord:
+    fields = dict(fields)
+    fields['status'] = oroshi.RecordStatus[fields['status']]
+    return oroshi.BookRecord(**fields)
+
+
+def record_to_json(record: oroshi.BookRecord) -> str:
+    return json.dumps(record_to_dict(record), ensure_ascii=False)
+
+
+def record_from_json(s: str) -> oroshi.BookRecord:
+    return record_from_dict(json.loads(s))
+
+
+# WriteQueue is a durable FIFO of writes to a bookstore, kept in a SQLite
+# file. Writes which conflicted with another edit stay in the file for review,
+# and are kept after they were reviewed as well.
+class WriteQueue:
+    SCHEMA = '''
+        CREATE TABLE IF NOT EXISTS writes (
+            write_id INTEGER PRIMARY KEY AUTOINCREMENT,
+            kind TEXT NOT NULL,
+            record_id INTEGER,
+            record TEXT NOT NULL,
+            state TEXT NOT NULL,
+            message TEXT
+        );
+        CREATE INDEX IF NOT EXISTS writes_state ON writes (state);
+    '''
+
+    def __init__(self, path: str):
+        # The queue is shared with the thread of BackgroundFlusher.
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._lock = threading.Lock()
+        with self._conn:
+            self._conn.executescript(self.SCHEMA)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self._conn.close()
+
+    def put(self, kind: str, record: oroshi.BookRecord):
+        with self._lock, self._conn:
+            self._conn.execute(
+                'INSERT INTO writes (kind, record_id, record, state) '
+                'VALUES (?, ?, ?, ?)',
+                (kind, record.record_id, record_to_json(record), PENDING))
+
+    def _select(self, state: str) -> List[tuple]:
+        with self._lock:
+            return self._conn.execute(
+                'SELECT write_id, kind, record, message FROM writes '
+                'WHERE state = ? ORDER BY write_id', (state,)).fetchall()
+
+    def pending(self) -> List[QueuedWrite]:
+        return [QueuedWrite(write_id, kind, record_from_json(record))
+                for write_id, kind, record, _ in self._select(PENDING)]
+
+    def conflicts(self) -> List[tuple]:
+        # returns (QueuedWrite, message) pairs
+        return [(QueuedWrite(write_id, kind, record_from_json(record)), message)
+                for write_id, kind, record, message in self._select(CONFLICT)]
+
+    def num_pending(self) -> int:
+        with self._lock:
+            return self._conn.execute(
+                'SELECT count(*) FROM writes WHERE state = ?',
+                (PENDING,)).fetchone()[0]
+
+    def mark_done(self, writes: Iterable[QueuedWrite],
+                  new_revisions: dict = None):
+        # new_revisions (record_id -> revision) are what the writes produced.
+        # The pending writes for those records are checked against them, even
+        # if the flush is interrupted and retried later.
+        with self._lock, self._conn:
+            self._conn.executemany(
+                'UPDATE writes SET state = ? WHERE write_id = ?',
+                ((DONE, w.write_id) for w in writes))
+            for record_id, revision in (new_revisions or {}).items():
+                rows = self._conn.execute(
+                    'SELECT write_id, record FROM writes '
+                    'WHERE state = ? AND record_id = ?',
+                    (PENDING, record_id)).fetchall()
+                self._conn.executemany(
+                    'UPDATE writes SET record = ? WHERE write_id = ?',
+                    ((record_to_json(record_from_json(record)._replace(
+                        revision=revision)), write_id)
+                     for write_id, record in rows))
+
+    def mark_conflict(self, write: QueuedWrite, message: str):
+        with self._lock, self._conn:
+            self._conn.execute(
+                'UPDATE writes SET state = ?, message = ? WHERE write_id = ?',
+                (CONFLICT, message, write.write_id))
+
+    def mark_reviewed(self, writes: Iterable[QueuedWrite]) -> int:
+        # Marks the conflicts as reviewed so that they are not shown again,
+        # and returns how many were marked.
+        with self._lock, self._conn:
+            return sum(self._conn.execute(
+                'UPDATE writes SET state = ? WHERE write_id = ? AND state = ?',
+                (REVIEWED, w.write_id, CONFLICT)).rowcount for w in writes)
+
+
+# WriteBehindBookstore reads from the given bookstore but puts every write
+# into the queue. Reads see the queued writes, so records which were already
+# taken inventory of are not proposed again before the queue is flushed.
+class WriteBehindBookstore(oroshi.Bookstore):
+    def __init__(self, bookstore: oroshi.Bookstore, queue: WriteQueue):
+        self._bookstore = bookstore
+        self._queue = queue
+        # records as read from the bookstore, to know their revisions
+        self._read_records = {}
+        self._overlay = {}
+        self._added = {}
+        for write in queue.pending():
+            self._apply_to_overlay(write.kind, write.record)
+
+    def _apply_to_overlay(self, kind: str, record: oroshi.BookRecord):
+        if kind == ADD:
+            isbn = oroshi.get_isbn(record)
+            self._added.setdefault(isbn, []).append(record)
+            return
+
+        current = self._overlay.get(record.record_id, record)
+        if kind == FOUND:
+            self._overlay[record.record_id] = current._replace(
+                status=oroshi.RecordStatus.IN_SHELF)
+        else:
+            self._overlay[record.record_id] = record._replace(
+                status=current.status)
+
+    def _overlaid(self, records: Iterable[oroshi.BookRecord]) \
+            -> Iterable[oroshi.BookRecord]:
+        for record in records:
+            self._read_records[record.record_id] = record
+            yield self._overlay.get(record.record_id, record)
+
+    def _read_record(self, record_id: int) -> oroshi.BookRecord:
+        record = self._read_records.get(record_id)
+        if record is None:
+            record = self._bookstore.get_record(record_id)
+            self._read_records[record_id] = record
+        return record
+
+    def find_records_by_isbn(self, isbn: str) -> Iterable[oroshi.BookRecord]:
+        yield from self._overlaid(self._bookstore.find_records_by_isbn(isbn))
+        yield from self._added.get(isbn, [])
+
+    def find_records_by_isbns(self, isbns: Iterable[str]) \
+            -> Iterable[oroshi.BookRecord]:
+        isbns = list(isbns)
+        yield from self._overlaid(self._bookstore.find_records_by_isbns(isbns))
+        for isbn in isbns:
+            yield from self._added.get(isbn, [])
+
+    def get_record(self, record_id: int) -> oroshi.BookRecord:
+        record, = self._overlaid([self._bookstore.get_record(record_id)])
+        return record
+
+    def get_revisions(self, record_ids: Iterable[int]) -> dict:
+        # Queued writes do not change revisions until they are flushed.
+        return self._bookstore.get_revisions(record_ids)
+
+    def add_record(self, record: oroshi.BookRecord):
+        self._queue.put(ADD, record)
+        self._apply_to_overlay(ADD, record)
+
+    def update_record(self, record: oroshi.BookRecord):
+        if record.revision is None:
+            revision = self._read_record(record.record_id).revision
+            record = record._replace(revision=revision)
+        self._queue.put(UPDATE, record)
+        self._apply_to_overlay(UPDATE, record)
+
+    def found(self, record_id: int):
+        record = self._read_record(record_id)
+        self._queue.put(FOUND, record)
+        self._apply_to_overlay(FOUND, record)
+
+    def close(self):
+        self._bookstore.close()
+
+
+FlushResult = collections.namedtuple(
+    'FlushResult', ['num_done', 'num_conflicts'])
+
+
+# Flusher pushes the queued writes to the bookstore in batches: first all
+# additions, then status changes, then updates. Found writes a status change
+# and an update for the same record, and the update has to be checked
+# against the revision which the status change produced.
+#
+# A batch which the bookstore rejects with RecordsRejected is sent again one
+# write at a time, so that the other writes of the batch go through. A write
+# rejected MAX_REJECTIONS times, counted over the flushes of this Flusher, is
+# marked as a conflict with the error. Until then it is tried again in the
+# next flush, and the later writes for the same record wait for it.
+#
+# local, if given, is the offline bookstore the writes were queued against,
+# such as offline.SqliteBookstore. The flushed books are read back from the
+# bookstore into it with import_records, so that the next session sees them
+# with their new revisions once the writes are done and leave the queue.
+class Flusher:
+    BATCH_SIZE = 100
+    MAX_RETRIES = 3
+    MAX_REJECTIONS = 3
+
+    def __init__(self, queue: WriteQueue, bookstore: oroshi.Bookstore, *,
+                 local=None, progress=None):
+        self._queue = queue
+        self._bookstore = bookstore
+        self._local = local
+        self._progress = oroshi.log if progress is None else progress
+        self.num_errors = 0
+        # write_id -> how many times the write was rejected
+        self._rejections = collections.Counter()
+
+    def flush(self) -> FlushResult:
+        writes_by_kind = {ADD: [], FOUND: [], UPDATE: []}
+        for write in self._queue.pending():
+            writes_by_kind[write.kind].append(write)
+
+        self._num_done = 0
+        self._num_conflicts = 0
+        # record_id -> revision which the next write must be checked against
+        self._revisions = {}
+        self._conflicted_ids = set()
+        # records whose rejected writes are tried again in the next flush
+        self._deferred_ids = set()
+        self._done_isbns = set()
+
+        try:
+            for batch in oroshi.chunked(writes_by_kind[ADD], self.BATCH_SIZE):
+                self._add_batch(batch)
+
+            self._flush_checked(
+                writes_by_kind[FOUND], self._bookstore.found_records)
+            self._flush_checked(writes_by_kind[UPDATE], self._update_records)
+        finally:
+            if self._local is not None and self._done_isbns:
+                self._refresh_local()
+
+        result = FlushResult(self._num_done, self._num_conflicts)
+        if result.num_done or result.num_conflicts:
+            self._progress('flushed {} writes, {} conflicts'.format(*result))
+        return result
+
+    def _add_batch(self, batch: List[QueuedWrite]):
+        try:
+            self._bookstore.add_records(w.record for w in batch)
+        except oroshi.RecordsRejected as e:
+            self._rejected(batch, e, self._add_batch)
+            return
+        self._done(batch)
+
+    def _update_records(self, records: List[oroshi.BookRecord]) -> dict:
+        self._bookstore.update_records(records)
+        return {}
+
+    def flush_quietly(self) -> FlushResult:
+        # Errors of the network or of the kintone API, such as a rate limit,
+        # are logged and counted; the writes stay in the queue for the next
+        # try.
+        try:
+            return self.flush()
+        except Exception as e:
+            self.num_errors += 1
+            self._progress('failed to flush the write queue: {!r}'.format(e))
+            return None
+
+    def _done(self, writes: List[QueuedWrite], new_revisions: dict = None):
+        self._queue.mark_done(writes, new_revisions)
+        self._num_done += len(writes)
+        self._done_isbns.update(oroshi.get_isbn(w.record) for w in writes)
+
+    def _refresh_local(self):
+        for isbns in oroshi.chunked(sorted(self._done_isbns), self.BATCH_SIZE):
+            self._local.import_records(
+                self._bookstore.find_records_by_isbns(isbns))
+
+    def _rejected(self, batch: List[QueuedWrite], error: Exception, send):
+        if len(batch) > 1:
+            for write in batch:
+                send([write])
+            return
+        write, = batch
+        self._rejections[write.write_id] += 1
+        n = self._rejections[write.write_id]
+        if n >= self.MAX_REJECTIONS:
+            del self._rejections[write.write_id]
+            self._conflict(write, 'rejected {} times: {}'.format(n, error))
+            return
+        self._progress('{} write for record {} was rejected: {}'.format(
+            write.kind, write.record.record_id, error))
+        if write.record.record_id is not None:
+            self._deferred_ids.add(write.record.record_id)
+
+    def _conflict(self, write: QueuedWrite, message: str):
+        self._queue.mark_conflict(write, message)
+        self._conflicted_ids.add(write.record.record_id)
+        self._num_conflicts += 1
+
+    def _flush_checked(self, writes: List[QueuedWrite], apply):
+        # A batch must not have two writes for the same record, because each
+        # of them is checked against the same revision.
+        while writes:
+            batch, writes = self._next_batch(writes)
+            self._flush_batch(batch, apply)
+
+    def _next_batch(self, writes: List[QueuedWrite]):
+        batch = []
+        rest = []
+        record_ids = set()
+        for write in writes:
+            record_id = write.record.record_id
+            if len(batch) < self.BATCH_SIZE and record_id not in record_ids:
+                record_ids.add(record_id)
+                batch.append(write)
+            else:
+                rest.append(write)
+        return batch, rest
+
+    def _flush_batch(self, batch: List[QueuedWrite], apply):
+        for _ in range(self.MAX_RETRIES):
+            batch = self._check_revisions(batch)
+            if not batch:
+                return
+            records = [self._with_expected_revision(w.record) for w in batch]
+            try:
+                new_revisions = apply(records)
+            except oroshi.RevisionConflict:
+                # Somebody edited a record after the check. Check again.
+                continue
+            except oroshi.RecordsRejected as e:
+                self._rejected(
+                    batch, e, lambda writes: self._flush_batch(writes, apply))
+                return
+            for record_id, revision in new_revisions.items():
+                self._revisions[record_id] = revision
+            self._done(batch, new_revisions)
+            return
+        for write in batch:
+            self._conflict(write, 'the record kept changing while flushing')
+
+    def _with_expected_revision(self, record: oroshi.BookRecord) \
+            -> oroshi.BookRecord:
+        return record._replace(
+            revision=self._revisions.get(record.record_id, record.revision))
+
+    def _check_revisions(self, batch: List[QueuedWrite]) -> List[QueuedWrite]:
+        batch = [w for w in batch if not self._skip_conflicted(w)
+                 and w.record.record_id not in self._deferred_ids]
+        if not batch:
+            return batch
+        current = self._bookstore.get_revisions(
+            w.record.record_id for w in batch)
+
+        checked = []
+        for write in batch:
+            record = self._with_expected_revision(write.record)
+            if record.record_id not in current:
+                self._conflict(write, 'the record was deleted')
+            elif record.revision is None:
+                # Such as a record read from a CSV file without revisions.
+                # Writing it could overwrite an edit made in the bookstore.
+                self._conflict(write, 'the record has no revision to check')
+            elif current[record.record_id] != record.revision:
+                self._conflict(
+                    write, 'the record was changed: revision {} -> {}'.format(
+                        record.revision, current[record.record_id]))
+            else:
+                checked.append(write)
+        return checked
+
+    def _skip_conflicted(self, write: QueuedWrite) -> bool:
+        # Later writes for a record which conflicted need a review as well.
+        if write.record.record_id in self._conflicted_ids:
+            self._conflict(write, 'an earlier write for the record conflicted')
+            return True
+        return False
+
+
+# BackgroundFlusher flushes the queue every `interval` seconds. Errors are
+# logged and retried on the next tick, so the operator can keep scanning
+# while kintone is unreachable or refuses requests.
+class BackgroundFlusher:
+    def __init__(self, flusher: Flusher, interval: float):
+        self._flusher = flusher
+        self._interval = interval
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    @property
+    def num_errors(self) -> int:
+        return self._flusher.num_errors
+
+    def _run(self):
+        while not self._stop.wait(self._interval):
+            self._flusher.flush_quietly()
+
+
+MAX_FAILURES = 10
+
+
+def flush_until_empty(flusher: Flusher, queue: WriteQueue, interval: float,
+                      *, max_failures: int = MAX_FAILURES) -> bool:
+    # Returns False if flushing failed max_failures times in a row, such as
+    # with a wrong API token; the writes are left in the queue then.
+    failures = 0
+    while True:
+        if flusher.flush_quietly() is None:
+            failures += 1
+        else:
+            failures = 0
+        if queue.num_pending() == 0:
+            return True
+        if failures >= max_failures:
+            return False
+        time.sleep(interval)